@@ -0,0 +1,76 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+db和orm热点路径的端到端基准,运行在sqlite驱动上,不需要MySQL
+默认使用内存数据库,也可以传入数据库文件名测量包含磁盘写入的开销
+运行: python bench/bench_db.py [database]
+"""
+
+import os
+import sys
+import timeit
+
+WWW = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(WWW, 'transwarp'))
+sys.path.insert(0, WWW)
+
+import db
+from models import User, Blog, Comment
+
+def create_tables(*models):
+	for model in models:
+		db.update('drop table if exists `%s`' % model.__table__)
+		sql = '\n'.join([line for line in model().__sql__().splitlines() if not line.startswith('--')])
+		for statement in sql.split(';'):
+			if statement.strip():
+				db.update(statement)
+
+def setup(database):
+	db.create_engine(database=database, driver='sqlite')
+	create_tables(User, Blog, Comment)
+	db.insert_many('blogs', [dict(id='%06d' % i, user_id='u%d' % (i % 10), user_name='Bob', user_image='about:blank',
+			name='Blog %d' % i, summary='summary', content='content ' * 50, created_at=float(i)) for i in range(1000)])
+
+_counter = [10 ** 6]
+
+def _next():
+	_counter[0] += 1
+	return str(_counter[0])
+
+def _insert_many():
+	rows = [(_next(), 'bench', 'Bob', 'about:blank', 'name', 'summary', 'content', 1.0) for i in range(100)]
+	db.insert_many('blogs', rows, columns=('id', 'user_id', 'user_name', 'user_image', 'name', 'summary', 'content', 'created_at'))
+
+def _updata():
+	b = Blog.get('000500')
+	b.name = _next()
+	b.updata()
+
+CASES = [
+	('db.select_one', lambda: db.select_one('select * from blogs where id=?', '000500')),
+	('db.select(20)', lambda: db.select('select * from blogs where user_id=? limit 20', 'u1')),
+	('db.select_int', lambda: db.select_int('select count(*) from blogs where user_id=?', 'u1')),
+	('db.update', lambda: db.update('update blogs set name=? where id=?', 'x', '000500')),
+	('db.insert', lambda: db.insert('blogs', id=_next(), user_id='bench', user_name='Bob', user_image='about:blank',
+			name='n', summary='s', content='c', created_at=1.0)),
+	('db.insert_many/row', _insert_many, 100),
+	('Blog.get', lambda: Blog.get('000500')),
+	('Blog.find_by(20)', lambda: Blog.find_by('where user_id=? limit 20', 'u1')),
+	('Blog.count_by', lambda: Blog.count_by('where user_id=?', 'u1')),
+	('Blog.insert', lambda: Blog(id=_next(), user_id='bench', user_name='Bob', user_image='about:blank',
+			name='n', summary='s', content='c').insert()),
+	('Blog.get+updata', _updata),
+]
+
+def main(database=':memory:', number=2000):
+	setup(database)
+	print '%-20s %12s' % ('operation', 'us/op')
+	for case in CASES:
+		name, func = case[:2]
+		per_call = case[2] if len(case) > 2 else 1
+		t = min(timeit.repeat(func, number=number, repeat=3)) / number / per_call * 1e6
+		print '%-20s %12.2f' % (name, t)
+
+if __name__ == '__main__':
+	main(*sys.argv[1:2])
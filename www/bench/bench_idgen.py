@@ -0,0 +1,48 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+主键id生成器的基准,比较db.next_id与IdGenerator生成整数和字符串id的速度,
+以及多个线程同时生成时的吞吐和id的唯一性
+运行: python bench/bench_idgen.py
+"""
+
+import os
+import sys
+import threading
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'transwarp'))
+
+import db
+
+CASES = [
+	('next_id', db.next_id),
+	('next_int_id', db.next_int_id),
+	('next_short_id', db.next_short_id),
+]
+
+def threaded(func, threads=8, per_thread=20000):
+	results = [None] * threads
+	def run(i):
+		results[i] = [func() for n in xrange(per_thread)]
+	L = [threading.Thread(target=run, args=(i,)) for i in range(threads)]
+	start = time.time()
+	for t in L:
+		t.start()
+	for t in L:
+		t.join()
+	elapsed = time.time() - start
+	ids = [x for r in results for x in r]
+	return elapsed / len(ids) * 1e6, len(set(ids)) == len(ids)
+
+def main(number=100000):
+	print '%-14s %10s %14s %8s %7s' % ('generator', 'us/id', '8 threads us', 'unique', 'length')
+	for name, func in CASES:
+		t = min(timeit.repeat(func, number=number, repeat=3)) / number * 1e6
+		mt, unique = threaded(func)
+		print '%-14s %10.3f %14.3f %8s %7d' % (name, t, mt, unique, len(str(func())))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,115 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+orm热点路径的微基准
+把db模块的select_one/select_int/update换成直接返回的桩函数,只测量orm自身每次操作的开销,
+"before"是改成预编译sql之前的写法(每次格式化sql,遍历__mappings__,hasattr/getattr,callable),
+"after"是当前Model的实现
+运行: python bench/bench_orm.py
+"""
+
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'transwarp'))
+
+import db
+import orm
+
+class Blog(orm.Model):
+	__table__ = 'blogs'
+
+	id = orm.StringField(primary_key=True, default=db.next_id, ddl='varchar(50)')
+	user_id = orm.StringField(updatable=False, ddl='varchar(50)')
+	user_name = orm.StringField(ddl='varchar(50)')
+	user_image = orm.StringField(ddl='varchar(500)')
+	name = orm.StringField(ddl='varchar(50)')
+	summary = orm.StringField(ddl='varchar(200)')
+	content = orm.TextField()
+	created_at = orm.FloatField(updatable=False, default=time.time)
+
+_ROW = db._row_class(['id', 'user_id', 'user_name', 'user_image', 'name', 'summary', 'content', 'created_at'])(
+		('0014', 'u1', 'Bob', 'about:blank', 'Hello', 'summary', 'content', 1.0))
+
+def _select_one(sql, *args):
+	return _ROW
+
+def _select_int(sql, *args):
+	return 1
+
+def _update(sql, *args):
+	return 1
+
+db.select_one = _select_one
+db.select_int = _select_int
+db.update = _update
+
+
+def legacy_get(cls, pk):
+	d = db.select_one('select * from %s where %s=?' % (cls.__table__, cls.__primary_key__.name), pk)
+	return cls(**d) if d else None
+
+def legacy_count_by(cls, where, *args):
+	return db.select_int('select count(`%s`) from `%s` %s' % (cls.__primary_key__.name, cls.__table__, where), *args)
+
+def legacy_default(f):
+	d = f._default
+	return d() if callable(d) else d
+
+def legacy_insert(self):
+	params = {}
+	for k, v in self.__mappings__.iteritems():
+		if v.insertable:
+			if not hasattr(self, k):
+				setattr(self, k, legacy_default(v))
+			params[v.name] = getattr(self, k)
+	cols, args = zip(*params.iteritems())
+	sql = 'insert into `%s` (%s) values (%s)' % (self.__table__, ','.join(['`%s`' % col for col in cols]), ','.join(['?' for i in range(len(cols))]))
+	return db.update(sql, *args)
+
+def legacy_updata(self):
+	L = []
+	args = []
+	for k, v in self.__mappings__.iteritems():
+		if v.updatable:
+			if hasattr(self, k):
+				arg = getattr(self, k)
+			else:
+				arg = legacy_default(v)
+				setattr(self, k, arg)
+			L.append('`%s`=?' % k)
+			args.append(arg)
+	pk = self.__primary_key__.name
+	args.append(getattr(self, pk))
+	db.update('update `%s` set %s where %s = ?' % (self.__table__, ','.join(L), pk), *args)
+
+def legacy_delete(self):
+	pk = self.__primary_key__.name
+	db.update('delete from `%s` where `%s`=?' % (self.__table__, pk), getattr(self, pk))
+
+
+def _changed():
+	b = Blog._from_row(_ROW)
+	b.name = 'World'
+	return b
+
+CASES = [
+	('get', lambda: legacy_get(Blog, '0014'), lambda: Blog.get('0014')),
+	('count_by', lambda: legacy_count_by(Blog, 'where user_id=?', 'u1'), lambda: Blog.count_by('where user_id=?', 'u1')),
+	('insert', lambda: legacy_insert(Blog(user_id='u1', name='Hello')), lambda: Blog(user_id='u1', name='Hello').insert()),
+	('updata', lambda: legacy_updata(_changed()), lambda: _changed().updata()),
+	('delete', lambda: legacy_delete(Blog._from_row(_ROW)), lambda: Blog._from_row(_ROW).delete()),
+]
+
+def main(number=20000):
+	print '%-10s %12s %12s' % ('operation', 'before(us)', 'after(us)')
+	for name, before, after in CASES:
+		t1 = min(timeit.repeat(before, number=number, repeat=3)) / number * 1e6
+		t2 = min(timeit.repeat(after, number=number, repeat=3)) / number * 1e6
+		print '%-10s %12.2f %12.2f' % (name, t1, t2)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,98 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+响应header和状态行的基准,比较Response与旧实现(每次读取headers都重新拼列表,状态行按需格式化)
+每次响应的开销分为:只有缺省header的响应,设置了几个header和cookie的响应,设置数字状态码,
+以及构造404错误(旧实现每次新建异常并格式化状态行,新实现返回共享实例)
+运行: python bench/bench_response.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'transwarp'))
+
+import web
+
+class LegacyResponse(object):
+	"""
+	旧的Response:header按大写保存值,读取headers时逐个查规范写法
+	"""
+	def __init__(self):
+		self._status = '200 OK'
+		self._headers = {'CONTENT-TYPE': 'text/html;charset=utf-8'}
+
+	def set_header(self, name, value):
+		key = name.upper()
+		if key not in web._RESPONSE_HEADER_DICT:
+			key = name
+		self._headers[key] = web.utils.to_str(value)
+
+	@property
+	def headers(self):
+		L = [(web._RESPONSE_HEADER_DICT.get(k, k), v) for k, v in self._headers.iteritems()]
+		if hasattr(self, '_cookies'):
+			for v in self._cookies.itervalues():
+				L.append(('Set-Cookie', v))
+		L.append(web._HEADER_X_POWERED_BY)
+		return L
+
+	def set_cookie(self, name, value):
+		if not hasattr(self, '_cookies'):
+			self._cookies = {}
+		self._cookies[name] = '%s=%s; Path=/; HttpOnly' % (web.utils.quote(name), web.utils.quote(value))
+
+	def set_status(self, value):
+		self._status = '%d %s' % (value, web._RESPONSE_STATUSES[value])
+
+def default_response(cls):
+	r = cls()
+	# 服务器和中间件通常会读取两次: start_response和日志
+	r.headers
+	r.headers
+
+def full_response(cls):
+	r = cls()
+	r.set_header('Content-Type', 'application/json')
+	r.set_header('Cache-Control', 'no-cache')
+	r.set_header('X-Request-Id', 'abc123')
+	r.set_cookie('session', 'xyz')
+	r.headers
+	r.headers
+
+def legacy_status():
+	LegacyResponse().set_status(404)
+
+def new_status():
+	web.Response().status = 404
+
+class LegacyHttpError(Exception):
+	"""
+	旧的_HttpError:每次构造都格式化状态行
+	"""
+	def __init__(self, code):
+		super(LegacyHttpError, self).__init__()
+		self.status = '%d %s' % (code, web._RESPONSE_STATUSES[code])
+		self._headers = None
+
+def legacy_notfound():
+	return LegacyHttpError(404)
+
+def measure(func, number):
+	return min(timeit.repeat(func, number=number, repeat=3)) / number * 1e6
+
+def main(number=100000):
+	cases = [
+		('default', lambda: default_response(LegacyResponse), lambda: default_response(web.Response)),
+		('full', lambda: full_response(LegacyResponse), lambda: full_response(web.Response)),
+		('status', legacy_status, new_status),
+		('404', legacy_notfound, web.HttpError.notfound),
+	]
+	print '%-8s %12s %12s' % ('case', 'legacy(us)', 'new(us)')
+	for name, legacy, new in cases:
+		print '%-8s %12.2f %12.2f' % (name, measure(legacy, number), measure(new, number))
+
+if __name__ == '__main__':
+	main()
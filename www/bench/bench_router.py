@@ -0,0 +1,72 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+路由分派的基准,比较Router与逐条尝试正则的路由表在不同路由数量下每次匹配的耗时
+每种规模一半是静态路径,一半是带参数的路径,分别测量命中最后注册的静态路由,
+命中最后注册的参数路由,以及不存在的路径(404)
+运行: python bench/bench_router.py
+"""
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'transwarp'))
+
+import web
+
+def handler(*args):
+	return args
+
+class LinearRouter(object):
+	"""
+	每条路由编译成一个正则,按注册顺序逐条尝试
+	"""
+	def __init__(self):
+		self._routes = []
+
+	def add(self, method, path, func):
+		regex = '^%s$' % re.sub(r':[a-zA-Z_]\w*', r'([^/]+)', path)
+		self._routes.append((method, re.compile(regex), func))
+
+	def match(self, method, path):
+		for m, regex, func in self._routes:
+			if m == method:
+				r = regex.match(path)
+				if r:
+					return func, list(r.groups())
+		raise web.HttpError.notfound()
+
+def build(router, n):
+	for i in range(n // 2):
+		router.add('GET', '/api/v1/static%d/list' % i, handler)
+		router.add('GET', '/api/v1/items%d/:id/comments/:cid' % i, handler)
+	return router
+
+def measure(router, method, path, number):
+	def run():
+		try:
+			router.match(method, path)
+		except web._HttpError:
+			pass
+	return min(timeit.repeat(run, number=number, repeat=3)) / number * 1e6
+
+def main(number=200000):
+	print '%6s %-8s %12s %12s' % ('routes', 'case', 'linear(us)', 'router(us)')
+	for n in (10, 100, 500, 1000):
+		last = n // 2 - 1
+		cases = [
+			('static', '/api/v1/static%d/list' % last),
+			('param', '/api/v1/items%d/42/comments/7' % last),
+			('404', '/api/v1/missing'),
+		]
+		linear = build(LinearRouter(), n)
+		router = build(web.Router(), n)
+		for name, path in cases:
+			# 逐条尝试的耗时随路由数增长,按规模减少次数
+			print '%6d %-8s %12.2f %12.2f' % (n, name, measure(linear, 'GET', path, number // n), measure(router, 'GET', path, number // 10))
+
+if __name__ == '__main__':
+	main()
@@ -17,7 +17,7 @@ class User(Model):
     __table__ = 'users'
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    email = StringField(updatable=False, ddl='varchar(50)')
+    email = StringField(updatable=False, ddl='varchar(50)', unique=True)
     password = StringField(ddl='varchar(50)')
     admin = BooleanField()
     name = StringField(ddl='varchar(50)')
@@ -28,21 +28,22 @@ class Blog(Model):
     __table__ = 'blogs'
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    user_id = StringField(updatable=False, ddl='varchar(50)')
+    user_id = StringField(updatable=False, ddl='varchar(50)', ref='User', index=True)
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
-    content = TextField()
-    created_at = FloatField(updatable=False, default=time.time)
+    content = TextField(deferred=True)
+    created_at = FloatField(updatable=False, default=time.time, index=True)
 
 class Comment(Model):
     __table__ = 'comments'
+    __indexes__ = [('blog_id', 'created_at')]
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    blog_id = StringField(updatable=False, ddl='varchar(50)')
-    user_id = StringField(updatable=False, ddl='varchar(50)')
+    blog_id = StringField(updatable=False, ddl='varchar(50)', ref='Blog')
+    user_id = StringField(updatable=False, ddl='varchar(50)', ref='User', index=True)
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
-    content = TextField()
+    content = TextField(deferred=True)
     created_at = FloatField(updatable=False, default=time.time)
@@ -0,0 +1,182 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+设计cache模块的原因:
+	1.减少数据库读取
+		同一个对象在一次请求内和多次请求间会被反复按主键读取,
+		把读到的行缓存起来,写入时让缓存失效,就能省掉大部分查询
+	2.缓存后端可替换
+		单进程时用进程内的LRUCache,多进程部署时用ExternalCache接入memcached之类的外部存储,
+		测试时用FakeClient代替外部存储
+设计cache接口:
+	所有后端都提供相同的方法:
+		get(key):取得缓存的值,没有或已过期时返回None
+		set(key,value,ttl=None):写入缓存,ttl为None时使用后端的缺省过期时间
+		delete(key):删除缓存
+		stats:命中(hits),未命中(misses),淘汰(evictions)的计数
+	使用样例:
+		from transwarp import cache
+		class User(Model):
+			__table__ = 'users'
+			__cache__ = cache.LRUCache(max_entries=10000, ttl=300)
+			__query_cache__ = cache.LRUCache(max_entries=10000, max_bytes=64 * 1024 * 1024)
+"""
+
+import collections
+import cPickle
+import sys
+import threading
+import time
+
+from db import Dict, Row
+
+# FakeClient.set的参数time会遮住time模块
+_now = time.time
+
+
+class LRUCache(object):
+	"""
+	进程内的LRU缓存
+	条目数超过max_entries,或设置了max_bytes且估算的总字节数超过max_bytes时,
+	淘汰最久未使用的条目,条目在ttl秒后过期(ttl为None时不过期)
+	>>> c = LRUCache(max_entries=2)
+	>>> c.set('a', 1); c.set('b', 2); c.set('c', 3)
+	>>> c.get('a') is None, c.get('c')
+	(True, 3)
+	>>> c.stats.evictions
+	1
+	"""
+	def __init__(self, max_entries=1000, ttl=None, max_bytes=None):
+		self.max_entries = max_entries
+		self.ttl = ttl
+		self.max_bytes = max_bytes
+		self.bytes = 0
+		self.stats = Dict(hits=0, misses=0, evictions=0)
+		self._data = collections.OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key):
+		with self._lock:
+			entry = self._data.pop(key, None)
+			if entry is not None:
+				expires, value, size = entry
+				if expires is None or expires > time.time():
+					self._data[key] = entry
+					self.stats.hits += 1
+					return value
+				self.bytes -= size
+			self.stats.misses += 1
+			return None
+
+	def set(self, key, value, ttl=None):
+		if ttl is None:
+			ttl = self.ttl
+		expires = None if ttl is None else time.time() + ttl
+		size = sizeof(value) if self.max_bytes else 0
+		with self._lock:
+			old = self._data.pop(key, None)
+			if old is not None:
+				self.bytes -= old[2]
+			if self.max_bytes and size > self.max_bytes:
+				return
+			self._data[key] = (expires, value, size)
+			self.bytes += size
+			while len(self._data) > self.max_entries or (self.max_bytes and self.bytes > self.max_bytes):
+				self.bytes -= self._data.popitem(last=False)[1][2]
+				self.stats.evictions += 1
+
+	def delete(self, key):
+		with self._lock:
+			old = self._data.pop(key, None)
+			if old is not None:
+				self.bytes -= old[2]
+
+	def clear(self):
+		with self._lock:
+			self._data.clear()
+			self.bytes = 0
+
+	def __len__(self):
+		return len(self._data)
+
+
+def sizeof(value):
+	"""
+	粗略估算值占用的字节数,递归计算元组,列表和字典中的元素
+	"""
+	size = sys.getsizeof(value)
+	if isinstance(value, (tuple, list)):
+		for v in value:
+			size += sizeof(v)
+	elif isinstance(value, dict):
+		for k, v in value.iteritems():
+			size += sizeof(k) + sizeof(v)
+	elif isinstance(value, Row):
+		for v in value.itervalues():
+			size += sizeof(v)
+	return size
+
+
+class ExternalCache(object):
+	"""
+	外部缓存,client需要提供memcached风格的接口:
+		client.get(key), client.set(key, value, time), client.delete(key)
+	key会加上prefix,值由client负责序列化,evictions由外部存储自己管理,这里不计数
+	"""
+	def __init__(self, client, prefix='', ttl=0):
+		self.client = client
+		self.prefix = prefix
+		self.ttl = ttl
+		self.stats = Dict(hits=0, misses=0, evictions=0)
+
+	def _key(self, key):
+		return '%s%s' % (self.prefix, key)
+
+	def get(self, key):
+		value = self.client.get(self._key(key))
+		if value is None:
+			self.stats.misses += 1
+		else:
+			self.stats.hits += 1
+		return value
+
+	def set(self, key, value, ttl=None):
+		self.client.set(self._key(key), value, self.ttl if ttl is None else ttl)
+
+	def delete(self, key):
+		self.client.delete(self._key(key))
+
+
+class FakeClient(object):
+	"""
+	进程内模拟的memcached客户端,用于测试ExternalCache
+	值以pickle形式保存,和真实的外部存储一样,取出的是副本
+	time为0表示不过期
+	"""
+	def __init__(self):
+		self._data = {}
+		self._lock = threading.Lock()
+
+	def get(self, key):
+		with self._lock:
+			entry = self._data.get(key)
+			if entry is None:
+				return None
+			expires, data = entry
+			if expires and expires <= time.time():
+				del self._data[key]
+				return None
+		return cPickle.loads(data)
+
+	def set(self, key, value, time=0):
+		data = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+		expires = _now() + time if time else 0
+		with self._lock:
+			self._data[key] = (expires, data)
+		return True
+
+	def delete(self, key):
+		with self._lock:
+			return self._data.pop(key, None) is not None
+
@@ -24,6 +24,8 @@
 							database = 'database',
 							host = '127.0.0.1',
 								port = 3306)
+			本地测试和基准测试时可以不连MySQL,使用内置的sqlite驱动:
+			db.create_engine(database = ':memory:', driver = 'sqlite')
 		2.执行SQL DML
 			select函数封装了如下功能
 			1.支持一个数据库连接里执行多个sql语句
@@ -39,12 +41,56 @@
 		3.支持事务
 			transaction函数封装了如下功能:
 			1.事务也可以嵌套,内层事务会自动合并到外层事务中,这种事务能满足99%的需求
+			2.transaction(savepoint=True)时内层事务用SAVEPOINT包裹,出错只回滚内层
+			3.retry_transaction装饰器在死锁或锁等待超时时重新执行整个事务
+			使用样例:
+			with db.transaction():
+				db.update('update user set name=? where id=?', 'A', 1)
+				try:
+					with db.transaction(savepoint=True):
+						db.insert('user', id=2, name='B')
+				except db.DBError:
+					pass
+			4.batch()中事务外的写入不再逐条提交,每max_statements条或每max_delay_ms毫秒提交一次
+			使用样例:
+			with db.batch(max_statements=200):
+				for blog in blogs:
+					blog.updata()
+		4.协程并发
+			本模块运行在python2上,没有asyncio/contextvars,无法提供async/await形式的接口
+			需要在一个进程里并发处理大量请求时,使用gevent的协程代替线程:
+			1.在导入db模块之前执行 from gevent import monkey; monkey.patch_all()
+			  _DbCtx继承的threading.local会变成协程本地对象,每个协程有自己的连接上下文,
+			  连接池里的threading.Condition也会变成协程间的等待,池满时只挂起当前协程
+			2.create_engine时传入use_pure=True,让mysql.connector使用纯python实现,
+			  这样网络读写走被替换过的socket,等待数据库时不会阻塞整个进程
+			3.用pool_max_size限制数据库的并发连接数,协程数可以远大于连接数
+			使用样例:
+			from gevent import monkey; monkey.patch_all()
+			from transwarp import db
+			db.create_engine(user = 'user', password = 'password', database = 'database',
+							host = '127.0.0.1', use_pure = True, pool_max_size = 20)
+		5.执行钩子与查询统计
+			add_hook(before,after)注册执行前后的回调,回调参数是QueryEvent,
+			包含sql,参数,规整后的sql形态(shape),连接,耗时,行数和异常,没有回调时几乎没有额外开销
+			enable_query_stats按sql形态统计次数,延迟分位数和行数,并记录慢查询
+			使用样例:
+			db.add_hook(after=db.log_query)
+			db.enable_query_stats(slow_threshold=0.5)
+			db.query_stats_report()
 """
+import collections
 import functools
+import itertools
+import json
+import sys
 import threading
 import time
 import uuid
 import logging
+import os
+import random
+import re
 
 def next_id(t=None):
 	"""
@@ -55,47 +101,955 @@ def next_id(t=None):
 	return '%015d%s000' % (int(t * 1000), uuid.uuid4().hex)
 
 
-def _profiling(start, sql=''):
+class IdGenerator(object):
 	"""
-	用于剖析sql的执行时间
+	按时间排序的唯一id生成器,生成64位整数:
+		41位毫秒时间戳(从2015-01-01起,可用到2084年) | 10位worker id | 12位序列号
+	同一进程内严格递增,时钟回拨时继续沿用上一个时间戳,不会产生重复或倒序的id
+	线程安全,fork后在子进程中第一次使用时会重置状态
+	worker_id不指定时取进程号的低10位,并在fork后按子进程的进程号重新计算,
+	同一台机器上进程号相差小于1024的进程(比如连续fork出的worker)不会重复;
+	多台机器或进程号可能相差1024的倍数时需要显式指定,
+	显式指定的worker_id在fork后原样被子进程继承,这时每个子进程要各自创建IdGenerator并指定不同的worker_id
 	"""
-	t = time.time() - start
-	if t > 0.1:
-		logging.warning('[PROFILING] [DB] %s: %s' % (t, sql))
-	else:
-		logging.info('[PROFILING] [DB] %s: %s' % (t, sql))
+	EPOCH = 1420070400000
+
+	def __init__(self, worker_id=None):
+		if worker_id is not None and not 0 <= worker_id < 1024:
+			raise ValueError('worker_id must be in [0, 1024).')
+		self._worker_id = worker_id
+		self._lock = threading.Lock()
+		self._reset()
+
+	def _reset(self):
+		self._pid = os.getpid()
+		worker_id = self._worker_id
+		if worker_id is None:
+			worker_id = self._pid & 0x3ff
+		self.worker_id = worker_id
+		self._worker_bits = worker_id << 12
+		self._last = 0
+		self._seq = 0
+
+	def next_int(self):
+		with self._lock:
+			if os.getpid() != self._pid:
+				self._reset()
+			now = int(time.time() * 1000) - self.EPOCH
+			if now > self._last:
+				self._last = now
+				self._seq = 0
+			else:
+				self._seq += 1
+				if self._seq > 0xfff:
+					# 同一毫秒内的序列号用完,借用下一毫秒
+					self._last += 1
+					self._seq = 0
+			return (self._last << 22) | self._worker_bits | self._seq
+
+	def next_str(self):
+		"""
+		13个字符的字符串形式,按字典序排序与按生成顺序一致
+		"""
+		return _encode_id(self.next_int())
+
+
+_ID_ALPHABET = '0123456789abcdefghijklmnopqrstuv'
+_ID_PAIRS = [a + b for a in _ID_ALPHABET for b in _ID_ALPHABET]
+
+def _encode_id(n):
+	"""
+	按5位一个字符编码成定长13个字符,每次查表取两个字符
+	"""
+	p = _ID_PAIRS
+	return ''.join((_ID_ALPHABET[n >> 60], p[(n >> 50) & 1023], p[(n >> 40) & 1023],
+			p[(n >> 30) & 1023], p[(n >> 20) & 1023], p[(n >> 10) & 1023], p[n & 1023]))
+
+id_generator = IdGenerator()
+
+def next_int_id():
+	"""
+	生成64位整数id,可作为主键的缺省值:
+		id = IntegerField(primary_key=True, default=next_int_id)
+	"""
+	return id_generator.next_int()
+
+def next_short_id():
+	"""
+	生成13个字符的可排序字符串id,可作为主键的缺省值:
+		id = StringField(primary_key=True, default=next_short_id, ddl='char(13)')
+	比next_id短得多,也不用每次读取os.urandom
+	"""
+	return _encode_id(id_generator.next_int())
+
 
 #global engine object:
 engine = None
 
-def create_engine(user,password,database,host,port = 3306,**kw):
+def create_engine(user=None,password=None,database=None,host=None,port = 3306,driver = 'mysql',**kw):
 	"""
 	db模型的核心函数,用于连接数据库,生成全局对象engine
-	engine对象持有数据库连接
+	engine对象持有数据库连接池
+	driver为'mysql'时使用mysql.connector,其余参数原样传给mysql.connector;
+	为'sqlite'时database是数据库文件名或':memory:',user/password/host/port被忽略
+	连接池参数:
+		pool_min_size: 常驻连接数,默认0
+		pool_max_size: 最大连接数,默认10
+		pool_timeout: 借出连接时最多等待的秒数,默认30
+		pool_max_idle: 空闲超过该秒数的连接被关闭,默认600
+		pool_max_lifetime: 存活超过该秒数的连接被关闭,默认3600
+		pool_pre_ping: 借出前检测连接是否可用,默认True
+		pool_ping_interval: 只检测空闲超过该秒数的连接,默认5,刚归还的连接直接借出
+	语句缓存参数:
+		statement_cache_size: 每个连接缓存的sql条数,默认64,为0时不缓存
+		prepared_statements: 是否对select/insert/update/delete使用服务端预处理,默认True,sqlite没有这一项
+	读写分离参数(仅mysql):
+		replicas: 只读副本列表,每项是覆盖主库连接参数的字典,比如[dict(host='10.0.0.2')]
+		replica_policy: 'round_robin'轮流使用副本,'least_outstanding'使用正在执行查询最少的副本
+		replica_retry: 副本出错后移出轮转的秒数,默认30
+	配置副本后select/select_one/select_int走副本,update/insert和事务中的查询走主库,
+	需要读到刚写入的数据时用use_primary()强制走主库
 	"""
-	import mysql.connector
 	global engine
 	if engine is not None:
 		raise DBError('Engine si already initialized.')
-	params = dict(user = user,password = password,database = database,host = host,port = port)
-	defaults = dict(use_unicode = True,charset = 'utf8',collation='utf8_general_ci',autocommit=False)
-	for k,v in defaults.iteritems():
-		params[k] = kw.pop(k,v)
-	params.update(kw)
-	params['buffered'] = True
-	engine = _Engine(lambda:mysql.connector.connect(**params))
-	logging.info('Init mysql engine <%s> ok.' % hex(id(engine)))
+	if driver not in ('mysql','sqlite'):
+		raise DBError('Unknown driver: %s' % driver)
+	pool_kw = dict()
+	for k,v in _POOL_DEFAULTS.iteritems():
+		pool_kw[k] = kw.pop('pool_%s' % k,v)
+	pool_kw['statement_cache_size'] = kw.pop('statement_cache_size',64)
+	pool_kw['prepared'] = kw.pop('prepared_statements',True)
+	replicas = kw.pop('replicas',())
+	policy = kw.pop('replica_policy','round_robin')
+	retry = kw.pop('replica_retry',30.0)
+	if driver == 'sqlite':
+		if replicas:
+			raise DBError('Replicas are not supported by sqlite.')
+		main = _SQLiteDriver(database,**kw)
+		if main.memory:
+			# 内存数据库只有一个共享连接,不能并发借出,也不能因空闲或过期被关闭
+			pool_kw.update(min_size = 0,max_size = 1,max_idle = 0,max_lifetime = 0,pre_ping = False)
+		engine = _Engine(main,(),policy,retry,**pool_kw)
+	else:
+		params = dict(user = user,password = password,database = database,host = host,port = port)
+		defaults = dict(use_unicode = True,charset = 'utf8',collation='utf8_general_ci',autocommit=False)
+		for k,v in defaults.iteritems():
+			params[k] = kw.pop(k,v)
+		params.update(kw)
+		params['buffered'] = True
+		main = _MySQLDriver(params)
+		engine = _Engine(main,[main.replica(replica) for replica in replicas],policy,retry,**pool_kw)
+	logging.info('Init %s engine <%s> ok.' % (driver,hex(id(engine))))
+
+
+# 表示连接已断开或连不上的错误码
+_DISCONNECT_ERRORS = frozenset([2003, 2005, 2006, 2013, 2055])
+# 死锁和锁等待超时,回滚后重新执行事务通常就能成功
+_RETRY_ERRORS = frozenset([1213, 1205])
+
+class _MySQLDriver(object):
+	"""
+	驱动封装了连接的创建和各数据库的差异:
+		connect(): 返回原始连接,需要提供cursor(**kw)/commit/rollback/ping/close
+		dialect: 生成DDL时使用的方言, placeholder: 驱动的参数占位符
+		prepared: 是否支持服务端预处理的游标, max_params: 一条语句最多的参数个数
+		is_disconnect(e)/is_retryable(e): 异常是否表示连接断开/死锁或锁等待超时
+	"""
+	dialect = 'mysql'
+	placeholder = '%s'
+	prepared = True
+	max_params = 65535
+
+	def __init__(self,params):
+		import mysql.connector
+		self.params = params
+		self.name = '%(host)s:%(port)s' % params
+		self.connect = functools.partial(mysql.connector.connect,**params)
+
+	def replica(self,override):
+		params = dict(self.params)
+		params.update(override)
+		return _MySQLDriver(params)
+
+	def is_disconnect(self,e):
+		return getattr(e,'errno',None) in _DISCONNECT_ERRORS
+
+	def is_retryable(self,e):
+		return getattr(e,'errno',None) in _RETRY_ERRORS
+
+	def close(self):
+		pass
+
+
+class _SQLiteDriver(object):
+	"""
+	python自带sqlite3的驱动,用于本地测试和基准测试
+	sql中的反引号sqlite也能识别,'?'占位符不需要改写
+	"""
+	dialect = 'sqlite'
+	placeholder = '?'
+	prepared = False
+
+	def __init__(self,database,**kw):
+		import sqlite3
+		self.sqlite3 = sqlite3
+		self.database = database
+		self.name = database
+		self.memory = database == ':memory:'
+		self.kw = kw
+		# 3.32之前一条语句最多999个参数
+		self.max_params = 32766 if sqlite3.sqlite_version_info >= (3,32,0) else 999
+		self._shared = self._open() if self.memory else None
+
+	def _open(self):
+		# 自己控制事务,连接在连接池的线程间传递
+		raw = self.sqlite3.connect(self.database,isolation_level = None,check_same_thread = False,**self.kw)
+		return _SQLiteConnection(raw,self.memory)
+
+	def connect(self):
+		if self._shared is not None:
+			return self._shared
+		return self._open()
+
+	def is_disconnect(self,e):
+		return False
+
+	def is_retryable(self,e):
+		return isinstance(e,self.sqlite3.OperationalError) and 'locked' in str(e)
+
+	def close(self):
+		if self._shared is not None:
+			self._shared.raw.close()
+
+
+class _SQLiteConnection(object):
+	"""
+	sqlite连接,模拟mysql关闭autocommit时的行为:
+	执行第一条非select语句前开始事务,直到commit或rollback
+	"""
+	def __init__(self,raw,shared):
+		self.raw = raw
+		self.shared = shared
+		self.in_transaction = False
+
+	def cursor(self,**kw):
+		return _SQLiteCursor(self)
+
+	def begin(self):
+		if not self.in_transaction:
+			self.raw.execute('BEGIN')
+			self.in_transaction = True
+
+	def commit(self):
+		if self.in_transaction:
+			self.raw.execute('COMMIT')
+			self.in_transaction = False
+
+	def rollback(self):
+		if self.in_transaction:
+			try:
+				self.raw.execute('ROLLBACK')
+			finally:
+				self.in_transaction = False
+
+	def ping(self):
+		self.raw.execute('select 1')
+
+	def close(self):
+		# 内存数据库关闭连接就丢失数据,共享连接由驱动关闭
+		if not self.shared:
+			self.raw.close()
+
+
+class _SQLiteCursor(object):
+	def __init__(self,connection):
+		self.connection = connection
+		self.cursor = connection.raw.cursor()
+
+	def execute(self,sql,args = ()):
+		if not sql.lstrip()[:7].lower().startswith(('select','explain')):
+			self.connection.begin()
+		self.cursor.execute(sql,args)
+
+	@property
+	def description(self):
+		return self.cursor.description
+
+	@property
+	def rowcount(self):
+		return self.cursor.rowcount
+
+	def fetchall(self):
+		return self.cursor.fetchall()
+
+	def fetchmany(self,size):
+		return self.cursor.fetchmany(size)
+
+	def close(self):
+		self.cursor.close()
+
+
+_POOL_DEFAULTS = dict(min_size = 0,max_size = 10,timeout = 30.0,max_idle = 600.0,max_lifetime = 3600.0,pre_ping = True,ping_interval = 5.0)
 
 
 class _Engine(object):
 	"""
 	数据库引擎对象
-	用于保存db模块的核心函数:create_engine创建出来的数据库连接
+	持有create_engine创建的驱动,主库连接池和各副本的连接池,
+	connect从主库池中借出连接,release归还连接,replica挑选一个可用的副本
 	"""
-	def __init__(self,connect):
-		self._connect = connect
+	def __init__(self,driver,replicas=(),policy='round_robin',retry_interval=30.0,**pool_kw):
+		if policy not in ('round_robin','least_outstanding'):
+			raise DBError('Invalid replica policy: %s' % policy)
+		self.driver = driver
+		self.pool = _ConnectionPool(driver,**pool_kw)
+		self.replicas = [_Replica(r.name,_ConnectionPool(r,**pool_kw),retry_interval) for r in replicas]
+		self.policy = policy
+		self._counter = itertools.count()
+
 	def connect(self):
-		return self._connect()
+		return self.pool.acquire()
+
+	def release(self,connection,discard=False):
+		self.pool.release(connection,discard)
+
+	def replica(self):
+		"""
+		按策略挑选一个健康的副本,全部不可用时返回None
+		"""
+		now = time.time()
+		live = [r for r in self.replicas if r.down_until <= now]
+		if not live:
+			return None
+		i = next(self._counter) % len(live)
+		if self.policy == 'least_outstanding':
+			# 从轮转位置开始找,查询数相同时不会总是落到第一个副本上
+			return min(live[i:] + live[:i],key=lambda r:r.outstanding)
+		return live[i]
+
+	def dispose(self):
+		self.pool.close()
+		for r in self.replicas:
+			r.pool.close()
+		self.driver.close()
+
+
+class _Replica(object):
+	"""
+	只读副本,记录正在执行的查询数和健康状况
+	连接失败或连接断开后,retry_interval秒内不再参与轮转
+	"""
+	def __init__(self,name,pool,retry_interval):
+		self.name = name
+		self.pool = pool
+		self.retry_interval = retry_interval
+		self.outstanding = 0
+		self.down_until = 0.0
+		self.stats = Dict(queries=0,failures=0)
+		self._lock = threading.Lock()
+
+	def connect(self):
+		conn = self.pool.acquire()
+		with self._lock:
+			self.outstanding += 1
+			self.stats.queries += 1
+		return conn
+
+	def release(self,conn,discard=False):
+		with self._lock:
+			self.outstanding -= 1
+		self.pool.release(conn,discard)
+
+	def mark_down(self,e):
+		with self._lock:
+			self.down_until = time.time() + self.retry_interval
+			self.stats.failures += 1
+		logging.warning('[REPLICA] %s out of rotation for %ss: %s' % (self.name,self.retry_interval,e))
+
+
+class _PooledConnection(object):
+	"""
+	连接池中的连接,包装驱动返回的原始连接,记录创建,借出和归还的时间
+	"""
+	def __init__(self,raw,statements):
+		self.raw = raw
+		self.statements = statements
+		self.created_at = self.returned_at = time.time()
+		self.checked_out_at = None
+
+	def cursor(self,**kw):
+		return self.raw.cursor(**kw)
+
+	def statement(self,sql):
+		return self.statements.get(self.raw,sql)
+
+	def commit(self):
+		self.raw.commit()
+
+	def rollback(self):
+		self.raw.rollback()
+
+	def ping(self):
+		self.raw.ping()
+
+	@property
+	def in_transaction(self):
+		# 驱动不提供这个属性时,按有未结束的事务处理
+		return getattr(self.raw,'in_transaction',True)
+
+	def close(self):
+		self.raw.close()
+
+
+class _ConnectionPool(object):
+	"""
+	有界连接池
+	空闲连接后进先出,使常用的连接保持活跃,过期的连接在借出时被清理
+	连接用完时借出方最多等待timeout秒,超时抛出PoolTimeoutError
+	归还时回滚未提交的内容,保证下一个借用者拿到干净的连接,连接不在事务中时省掉这次回滚
+	pre_ping只检测空闲超过ping_interval秒的连接,热点路径上借出和归还都不产生额外的往返
+	"""
+	def __init__(self,driver,min_size=0,max_size=10,timeout=30.0,max_idle=600.0,max_lifetime=3600.0,pre_ping=True,
+			statement_cache_size=64,prepared=True,ping_interval=5.0):
+		if max_size < 1 or min_size < 0 or min_size > max_size:
+			raise DBError('Invalid pool size: min_size=%s, max_size=%s' % (min_size,max_size))
+		self.driver = driver
+		self.min_size = min_size
+		self.max_size = max_size
+		self.timeout = timeout
+		self.max_idle = max_idle
+		self.max_lifetime = max_lifetime
+		self.pre_ping = pre_ping
+		self.ping_interval = ping_interval
+		self.statement_cache_size = statement_cache_size
+		self.prepared = prepared and driver.prepared
+		# 每个连接的语句缓存各自计数,只由借出连接的线程修改;关闭的连接把计数累加到这里
+		self._statement_caches = set()
+		self._closed_statement_stats = Dict(hits=0,misses=0,evictions=0)
+		self._idle = collections.deque()
+		self._size = 0
+		self._cond = threading.Condition()
+		self.stats = Dict(created=0,closed=0,checkouts=0,waits=0,wait_time=0.0,timeouts=0,checkout_time=0.0,ping_failures=0)
+		for i in range(min_size):
+			self._size += 1
+			self._idle.append(self._open())
+
+	def _open(self):
+		try:
+			statements = _StatementCache(self.statement_cache_size,self.prepared,self.driver.placeholder)
+			conn = _PooledConnection(self.driver.connect(),statements)
+		except:
+			with self._cond:
+				self._size -= 1
+				self._cond.notify()
+			raise
+		logging.info('[CONNECTION] [OPEN] connection <0x%x>...',id(conn))
+		with self._cond:
+			self.stats.created += 1
+			self._statement_caches.add(conn.statements)
+		return conn
+
+	def _close(self,conn):
+		logging.info('[CONNECTION] [CLOSE] connection <0x%x>...',id(conn))
+		with self._cond:
+			if conn.statements in self._statement_caches:
+				self._statement_caches.remove(conn.statements)
+				closed = self._closed_statement_stats
+				closed.hits += conn.statements.hits
+				closed.misses += conn.statements.misses
+				closed.evictions += conn.statements.evictions
+		try:
+			conn.close()
+		except Exception:
+			logging.warning('close connection <%s> failed.' % hex(id(conn)))
+
+	def _expired(self,conn,now):
+		if self.max_lifetime and now - conn.created_at > self.max_lifetime:
+			return True
+		return self.max_idle and now - conn.returned_at > self.max_idle
+
+	def _ping(self,conn):
+		try:
+			conn.ping()
+			return True
+		except Exception:
+			return False
+
+	def acquire(self):
+		start = time.time()
+		deadline = None
+		while True:
+			expired = []
+			conn = None
+			with self._cond:
+				while True:
+					now = time.time()
+					while self._idle and self._size - len(expired) > self.min_size and self._expired(self._idle[0],now):
+						expired.append(self._idle.popleft())
+					if self._idle:
+						conn = self._idle.pop()
+						break
+					if self._size < self.max_size:
+						self._size += 1
+						break
+					if deadline is None:
+						deadline = start + self.timeout
+						self.stats.waits += 1
+					remaining = deadline - now
+					if remaining <= 0:
+						self.stats.timeouts += 1
+						self.stats.wait_time += now - start
+						raise PoolTimeoutError('Timeout after %.3fs waiting for a connection.' % (now - start))
+					self._cond.wait(remaining)
+				self._size -= len(expired)
+				self.stats.closed += len(expired)
+			for c in expired:
+				self._close(c)
+			if conn is None:
+				conn = self._open()
+			elif self.pre_ping and now - conn.returned_at > self.ping_interval and not self._ping(conn):
+				with self._cond:
+					self._size -= 1
+					self.stats.closed += 1
+					self.stats.ping_failures += 1
+					self._cond.notify()
+				self._close(conn)
+				continue
+			break
+		now = time.time()
+		conn.checked_out_at = now
+		with self._cond:
+			self.stats.checkouts += 1
+			if deadline is not None:
+				self.stats.wait_time += now - start
+		return conn
+
+	def release(self,conn,discard=False):
+		if not discard and conn.in_transaction:
+			try:
+				conn.rollback()
+			except Exception:
+				discard = True
+		now = time.time()
+		if self.max_lifetime and now - conn.created_at > self.max_lifetime:
+			discard = True
+		with self._cond:
+			self.stats.checkout_time += now - conn.checked_out_at
+			conn.checked_out_at = None
+			if discard:
+				self._size -= 1
+				self.stats.closed += 1
+			else:
+				conn.returned_at = now
+				self._idle.append(conn)
+			self._cond.notify()
+		if discard:
+			self._close(conn)
+
+	def close(self):
+		"""
+		关闭所有空闲连接,已借出的连接归还后照常回收
+		"""
+		with self._cond:
+			idle = list(self._idle)
+			self._idle.clear()
+			self._size -= len(idle)
+			self.stats.closed += len(idle)
+		for conn in idle:
+			self._close(conn)
+
+	def statement_status(self):
+		with self._cond:
+			d = Dict(**self._closed_statement_stats)
+			for c in self._statement_caches:
+				d.hits += c.hits
+				d.misses += c.misses
+				d.evictions += c.evictions
+		return d
+
+	def status(self):
+		with self._cond:
+			d = Dict(**self.stats)
+			d.size = self._size
+			d.idle = len(self._idle)
+		return d
+
+
+_PREPARABLE = ('select','insert','update','delete','replace')
+
+class _Statement(object):
+	__slots__ = ('sql','cursor','table','used')
+
+	def __init__(self,sql,cursor,table):
+		self.sql = sql
+		self.cursor = cursor
+		self.table = table
+		self.used = 0
+
+
+class _StatementCache(object):
+	"""
+	单个连接上的语句缓存,以调用者传入的'?'形式sql为键
+	缓存改写成'%s'形式的sql,开启预处理时还缓存服务端预处理过的游标,
+	重复执行同一条sql时既不用再改写,服务端也不用再解析
+	预处理游标属于连接本身,随连接一起放回连接池,被淘汰时才关闭
+	命中时只查一次字典:开启预处理时记下使用顺序,满了淘汰最久未用的一条;
+	不预处理时缓存满了直接清空
+	连接同一时间只被一个线程借出,计数用普通整数,不需要加锁
+	"""
+	def __init__(self,size,prepared,placeholder='%s'):
+		self.size = size
+		self.prepared = prepared
+		self.placeholder = placeholder
+		self.hits = self.misses = self.evictions = 0
+		self._entries = {}
+		self._tick = 0
+
+	def get(self,raw,sql):
+		stmt = self._entries.get(sql)
+		if stmt is not None:
+			self.hits += 1
+			if self.prepared:
+				self._tick += 1
+				stmt.used = self._tick
+			return stmt
+		self.misses += 1
+		if self.size <= 0:
+			return _Statement(_format(sql,self.placeholder),None,_write_table(sql))
+		cursor = None
+		if self.prepared and sql.lstrip()[:7].lower().startswith(_PREPARABLE):
+			cursor = raw.cursor(buffered=False,prepared=True)
+		stmt = _Statement(_format(sql,self.placeholder),cursor,_write_table(sql))
+		entries = self._entries
+		if len(entries) >= self.size:
+			self._evict()
+		self._tick += 1
+		stmt.used = self._tick
+		entries[sql] = stmt
+		return stmt
+
+	def _evict(self):
+		entries = self._entries
+		if not self.prepared:
+			# 只缓存改写后的sql,重新生成很便宜,直接清空
+			self.evictions += len(entries)
+			entries.clear()
+			return
+		old_sql = min(entries,key=lambda k: entries[k].used)
+		old = entries.pop(old_sql)
+		self.evictions += 1
+		if old.cursor is not None:
+			try:
+				old.cursor.close()
+			except Exception:
+				logging.warning('close prepared cursor failed: %s' % old_sql)
+
+
+def _format(sql,placeholder):
+	"""
+	把调用者使用的'?'占位符改写成驱动的占位符
+	"""
+	return sql if placeholder == '?' else sql.replace('?',placeholder)
+
+
+_RE_WRITE_TABLE = re.compile(r'^\s*(?:insert\s+(?:ignore\s+)?into|replace\s+into|update|delete\s+from)\s+`?(\w+)`?', re.I)
+
+def _write_table(sql):
+	"""
+	取得写语句修改的表名,不是insert/replace/update/delete时返回None
+	"""
+	m = _RE_WRITE_TABLE.match(sql)
+	return m.group(1) if m else None
+
+
+_table_versions = {}
+_table_versions_lock = threading.Lock()
+
+def uncommitted():
+	"""
+	本线程在事务中,或批量中还有没提交的写入时返回True
+	这时读到的数据可能被回滚,或者和其他线程看到的不同,不能放进共享的缓存
+	"""
+	return bool(_db_ctx.transactions or _db_ctx.written or (_db_ctx.batch is not None and _db_ctx.batch.pending))
+
+def on_commit(func):
+	"""
+	有未提交的写入时把func推迟到提交之后执行,回滚时丢弃;否则立即执行
+	用于让缓存失效:提交前删除缓存,其他线程可能又把提交前的旧数据放进缓存
+	"""
+	if uncommitted():
+		_db_ctx.after_commit.append(func)
+	else:
+		func()
+
+def table_version(table):
+	"""
+	返回表的版本号,通过_update写入该表的事务每提交一次加1
+	查询缓存以此判断缓存的结果是否过期
+	版本号只记录本进程的写入,其他进程的写入需要靠缓存的ttl兜底
+	"""
+	return _table_versions.get(table, 0)
+
+def _bump_tables(tables):
+	with _table_versions_lock:
+		for table in tables:
+			_table_versions[table] = _table_versions.get(table, 0) + 1
+
+
+def pool_stats():
+	"""
+	返回连接池的计数:
+		size/idle: 当前连接数和空闲连接数
+		checkouts: 借出次数, checkout_time: 借出连接的累计占用秒数
+		waits/wait_time/timeouts: 因池满等待的次数,累计等待秒数,超时次数
+		created/closed/ping_failures: 新建,关闭,健康检查失败的连接数
+	"""
+	if engine is None:
+		raise DBError('Engine is not initialized.')
+	return engine.pool.status()
+
+
+def replica_stats():
+	"""
+	返回每个副本的查询数,失败次数,正在执行的查询数以及是否在轮转中
+	"""
+	if engine is None:
+		raise DBError('Engine is not initialized.')
+	now = time.time()
+	return [Dict(name=r.name,queries=r.stats.queries,failures=r.stats.failures,outstanding=r.outstanding,
+			healthy=r.down_until <= now,pool=r.pool.status()) for r in engine.replicas]
+
+
+def statement_cache_stats():
+	"""
+	返回所有连接上语句缓存的命中,未命中,淘汰次数
+	"""
+	if engine is None:
+		raise DBError('Engine is not initialized.')
+	return engine.pool.statement_status()
+
+
+class QueryEvent(object):
+	"""
+	一次sql执行的信息,传给执行钩子
+		sql/args: 调用者传入的sql和参数
+		shape: 把字面量和参数列表规整后的sql形态,用于聚合统计
+		connection_id: 执行所用连接的标识,与连接日志中的<0x...>一致
+		started: 开始时间, elapsed: 耗时秒数, rows: 返回或影响的行数, error: 出错时的异常
+	执行前的钩子中elapsed和rows为None
+	"""
+	__slots__ = ('sql','args','connection_id','started','elapsed','rows','error')
+
+	def __init__(self,sql,args,connection_id):
+		self.sql = sql
+		self.args = args
+		self.connection_id = connection_id
+		self.started = time.time()
+		self.elapsed = None
+		self.rows = None
+		self.error = None
+
+	@property
+	def shape(self):
+		return sql_shape(self.sql)
+
+
+_before_hooks = []
+_after_hooks = []
+# 有钩子时才走_instrumented,没有钩子时执行路径上只多一次判断
+_hooked = False
+
+def add_hook(before=None,after=None):
+	"""
+	注册执行前/执行后的钩子,参数都是QueryEvent
+	钩子在执行sql的线程中同步调用,应当尽量快,钩子抛出的异常会被记录并忽略
+	"""
+	global _hooked
+	if before is not None:
+		_before_hooks.append(before)
+	if after is not None:
+		_after_hooks.append(after)
+	_hooked = bool(_before_hooks or _after_hooks)
+
+def remove_hook(before=None,after=None):
+	global _hooked
+	if before in _before_hooks:
+		_before_hooks.remove(before)
+	if after in _after_hooks:
+		_after_hooks.remove(after)
+	_hooked = bool(_before_hooks or _after_hooks)
+
+def _run_hooks(hooks,event):
+	for hook in hooks:
+		try:
+			hook(event)
+		except Exception:
+			logging.exception('[HOOK] %r failed' % hook)
+
+def _instrumented(connection,sql,args,execute,*a):
+	"""
+	在钩子之间执行execute(*a),统计耗时和行数
+	"""
+	if isinstance(connection,_LasyConnection):
+		connection = connection.connection
+	event = QueryEvent(sql,args,hex(id(connection)))
+	_run_hooks(_before_hooks,event)
+	try:
+		r = execute(*a)
+	except Exception, e:
+		exc_info = sys.exc_info()
+		event.elapsed = time.time() - event.started
+		event.error = e
+		_run_hooks(_after_hooks,event)
+		raise exc_info[0],exc_info[1],exc_info[2]
+	event.elapsed = time.time() - event.started
+	event.rows = _row_count(r)
+	_run_hooks(_after_hooks,event)
+	return r
+
+def _row_count(r):
+	if r is None:
+		return 0
+	if isinstance(r,(int,long)):
+		return r
+	if isinstance(r,list):
+		return len(r)
+	return 1
+
+def log_query(event):
+	"""
+	把每条sql记录到INFO日志的钩子: db.add_hook(after=db.log_query)
+	"""
+	if event.error is None:
+		logging.info('SQL: %s, ARGS: %s, %d rows in %.3fms',event.sql,event.args,event.rows,event.elapsed * 1000)
+	else:
+		logging.info('SQL: %s, ARGS: %s, failed in %.3fms: %s',event.sql,event.args,event.elapsed * 1000,event.error)
+
+
+_RE_SHAPE_LITERAL = re.compile(r"'(?:[^'\\]|\\.)*'|\b\d+(?:\.\d+)?\b|%s")
+_RE_SHAPE_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))*')
+_RE_SHAPE_SPACE = re.compile(r'\s+')
+_shapes = {}
+
+def sql_shape(sql):
+	"""
+	把sql规整成形态:字符串和数字字面量变成?,参数列表和多行VALUES折叠成(...)
+	>>> sql_shape("select * from user where id in (?,?,?) and name='Bob'")
+	'select * from user where id in (...) and name=?'
+	>>> sql_shape('insert into `user` (`id`,`name`) values (%s,%s),(%s,%s)')
+	'insert into `user` (`id`,`name`) values (...)'
+	"""
+	shape = _shapes.get(sql)
+	if shape is None:
+		shape = _RE_SHAPE_LITERAL.sub('?',sql)
+		shape = _RE_SHAPE_LIST.sub('(...)',shape)
+		shape = _RE_SHAPE_SPACE.sub(' ',shape).strip()
+		if len(_shapes) >= 1024:
+			_shapes.clear()
+		_shapes[sql] = shape
+	return shape
+
+
+class QueryStats(object):
+	"""
+	按sql形态聚合的查询统计,作为执行后的钩子使用
+	每种形态记录次数,出错次数,慢查询次数,总耗时,最大耗时,总行数,
+	以及最近samples次耗时,报告时据此计算p50/p95/p99
+	耗时不少于slow_threshold秒的查询记为慢查询并打印警告
+	"""
+	def __init__(self,samples=1000,slow_threshold=None):
+		self.samples = samples
+		self.slow_threshold = slow_threshold
+		self._shapes = {}
+		self._lock = threading.Lock()
+
+	def __call__(self,event):
+		shape = event.shape
+		elapsed = event.elapsed
+		slow = self.slow_threshold is not None and elapsed >= self.slow_threshold
+		with self._lock:
+			entry = self._shapes.get(shape)
+			if entry is None:
+				entry = self._shapes[shape] = [0,0,0,0.0,0.0,0,collections.deque(maxlen=self.samples)]
+			entry[0] += 1
+			if event.error is not None:
+				entry[1] += 1
+			if slow:
+				entry[2] += 1
+			entry[3] += elapsed
+			if elapsed > entry[4]:
+				entry[4] = elapsed
+			entry[5] += event.rows or 0
+			entry[6].append(elapsed)
+		if slow:
+			logging.warning('[SLOW] [DB] %.3fs: %s, ARGS: %s' % (elapsed,event.sql,event.args))
+
+	def report(self):
+		"""
+		返回每种形态的统计,按总耗时从大到小排序,耗时单位为秒
+		"""
+		with self._lock:
+			items = [(shape,entry[:6],sorted(entry[6])) for shape,entry in self._shapes.iteritems()]
+		L = []
+		for shape,(count,errors,slow,total,max_time,rows),samples in items:
+			L.append(Dict(shape=shape,count=count,errors=errors,slow=slow,total_time=total,mean=total / count,
+					max=max_time,p50=_percentile(samples,0.5),p95=_percentile(samples,0.95),
+					p99=_percentile(samples,0.99),rows=rows))
+		L.sort(key=lambda x:-x.total_time)
+		return L
+
+	def reset(self):
+		with self._lock:
+			self._shapes.clear()
+
+	def wsgi_app(self,environ,start_response):
+		"""
+		以JSON形式输出report()的WSGI应用,可以挂在管理端口上
+		"""
+		body = json.dumps(self.report(),indent=2)
+		start_response('200 OK',[('Content-Type','application/json'),('Content-Length',str(len(body)))])
+		return [body]
+
+def _percentile(samples,q):
+	if not samples:
+		return None
+	return samples[min(len(samples) - 1,int(len(samples) * q))]
+
+
+_query_stats = None
+
+def enable_query_stats(samples=1000,slow_threshold=None):
+	"""
+	注册内置的QueryStats钩子并返回它,再次调用时替换原来的统计
+	"""
+	global _query_stats
+	disable_query_stats()
+	_query_stats = QueryStats(samples,slow_threshold)
+	add_hook(after=_query_stats)
+	return _query_stats
+
+def disable_query_stats():
+	global _query_stats
+	if _query_stats is not None:
+		remove_hook(after=_query_stats)
+		_query_stats = None
+
+def query_stats_report():
+	"""
+	返回内置统计的结果,未开启时返回空列表
+	"""
+	if _query_stats is None:
+		return []
+	return _query_stats.report()
+
+def query_stats_app(environ,start_response):
+	"""
+	输出内置统计结果的WSGI应用,未开启时输出空列表
+	"""
+	if _query_stats is None:
+		return QueryStats().wsgi_app(environ,start_response)
+	return _query_stats.wsgi_app(environ,start_response)
 
 
 class _DbCtx(threading.local):
@@ -112,6 +1066,10 @@ class _DbCtx(threading.local):
 		logging.info('open lazy connection...')
 		self.connection = None
 		self.transactions = 0
+		self.primary = 0
+		self.written = set()
+		self.after_commit = []
+		self.batch = None
 
 	def is_init(self):
 		return not self.connection is None
@@ -119,42 +1077,78 @@ class _DbCtx(threading.local):
 	def init(self):
 		self.connection = _LasyConnection()
 		self.transactions = 0
+		self.written = set()
+		self.after_commit = []
 
 	def cleanup(self):
 		self.connection.cleanup()
 		self.connection = None
+		self.rolled_back()
+
+	def committed(self):
+		"""
+		提交后让写过的表版本号加1,再执行on_commit推迟的函数,必须在提交之后做,
+		否则并发的查询可能把提交前的旧数据缓存到新版本号下
+		"""
+		if self.written:
+			_bump_tables(self.written)
+			self.written = set()
+		if self.after_commit:
+			L = self.after_commit
+			self.after_commit = []
+			for func in L:
+				try:
+					func()
+				except Exception, e:
+					logging.warning('after commit callback failed: %s' % e)
+
+	def rolled_back(self):
+		self.written = set()
+		self.after_commit = []
 
 	def cursor(self):
 		return self.connection.cursor()
 
+	def reads_from_replica(self):
+		return self.transactions == 0 and not self.primary and self.batch is None and engine.replicas
+
 _db_ctx = _DbCtx()
 
 class _LasyConnection(object):
 		"""
-		惰性连接,获取游标时才连接数据库
+		惰性连接,获取游标时才从连接池借出连接
 		"""
 		def __init__(self):
 			self.connection = None
 
-		def cursor(self):
+		def cursor(self,**kw):
+				return self._connect().cursor(**kw)
+
+		def statement(self,sql):
+			return self._connect().statement(sql)
+
+		def _connect(self):
 				if self.connection is None:
 					_connection = engine.connect()
-					logging.info('[CONNECTION] [OPEN] connection <%s>...' % hex(id(_connection)))
+					logging.debug('[CONNECTION] [CHECKOUT] connection <0x%x>...',id(_connection))
 					self.connection = _connection
-				return self.connection.cursor()
+				return self.connection
 
 		def commit(self):
-			self.connection.commit()
+			# 事务中没有执行过语句时还没有借出连接
+			if self.connection:
+				self.connection.commit()
 
 		def rollback(self):
-			self.connection.rollback()
+			if self.connection:
+				self.connection.rollback()
 
 		def cleanup(self):
 			if self.connection:
 				_connection = self.connection
 				self.connection = None
-				logging.info('[CONNECTION] [CLOSE] connection <%s>...' % hex(id(connection)))
-				_connection.close()
+				logging.debug('[CONNECTION] [RELEASE] connection <0x%x>...',id(_connection))
+				engine.release(_connection)
 
 
 class _ConnectionCtx(object):
@@ -190,38 +1184,286 @@ def with_connection(func):
 			return func(*args,**kw)
 	return _wrapper
 
-def transaction():
-	return _TransactionCtx()
+class _PrimaryCtx(object):
+	"""
+	在该上下文中的查询一律走主库,用于写入后马上读取的场景
+	"""
+	def __enter__(self):
+		global _db_ctx
+		_db_ctx.primary += 1
+		return self
+
+	def __exit__(self,exctype,excvalue,traceback):
+		global _db_ctx
+		_db_ctx.primary -= 1
+
+def use_primary():
+	return _PrimaryCtx()
+
+def with_primary(func):
+	@functools.wraps(func)
+	def _wrapper(*args,**kw):
+		with _PrimaryCtx():
+			return func(*args,**kw)
+	return _wrapper
+
+def transaction(savepoint=False):
+	"""
+	事务上下文,嵌套时内层合并到外层事务中
+	savepoint为True且已在事务中时,内层用SAVEPOINT包裹:
+	内层正常结束时释放保存点,出错时只回滚到保存点,外层捕获异常后可以继续并提交
+	>>> with transaction():
+	...     n = insert('user', id=3000, name='Adam', email='adam@test.org', passwd='1', last_modified=0)
+	...     try:
+	...         with transaction(savepoint=True):
+	...             n = insert('user', id=3001, name='Eve', email='eve@test.org', passwd='1', last_modified=0)
+	...             raise ValueError('undo 3001')
+	...     except ValueError:
+	...         pass
+	>>> [u.id for u in select('select id from user where id between 3000 and 3099')]
+	[3000]
+	>>> update('delete from user where id between 3000 and 3099')
+	1
+	"""
+	return _TransactionCtx(savepoint)
 
 def with_transaction(func):
 	@functools.wraps(func)
 	def _wrapper(*args,**kw):
 		with _TransactionCtx():
-			func(*args,**kw)
+			return func(*args,**kw)
 	return _wrapper
 
-@with_connection
+def batch(max_statements=100,max_delay_ms=100):
+	"""
+	批量提交上下文,其中事务外的写入合并提交:
+	积累max_statements条语句,或距第一条未提交的语句超过max_delay_ms毫秒时提交一次,
+	离开上下文时提交剩余的语句,即使是因为异常离开,与逐条自动提交的结果一致
+	每条语句的错误照常在该语句处抛出,只回滚这一条;但死锁会让服务端回滚整批未提交的语句
+	超时只在执行下一条语句和离开上下文时检查,不会有后台线程提交
+	批量期间的查询走主库连接,能读到尚未提交的写入;嵌套的batch合并到最外层
+	>>> before = batch_stats().batches
+	>>> with batch(max_statements=2):
+	...     for i in range(3):
+	...         n = insert('user', id=3200 + i, name='Abel', email='abel@test.org', passwd='1', last_modified=0)
+	...     batch_stats().batches - before
+	1
+	>>> batch_stats().batches - before, select_int('select count(*) from user where id between 3200 and 3299')
+	(2, 3)
+
+	批量中开始事务前先提交已执行的语句,事务回滚不会带走它们
+	>>> with batch():
+	...     n = insert('user', id=3300, name='Seth', email='seth@test.org', passwd='1', last_modified=0)
+	...     try:
+	...         with transaction():
+	...             n = insert('user', id=3301, name='Enos', email='enos@test.org', passwd='1', last_modified=0)
+	...             raise ValueError('undo 3301')
+	...     except ValueError:
+	...         pass
+	>>> [u.id for u in select('select id from user where id between 3300 and 3399')]
+	[3300]
+	>>> update('delete from user where id between 3200 and 3399')
+	4
+	"""
+	return _BatchCtx(max_statements,max_delay_ms / 1000.0)
+
+_batch_stats = dict(batches=0,statements=0,max_size=0,commit_time=0.0,max_commit_time=0.0)
+_batch_stats_lock = threading.Lock()
+
+def batch_stats():
+	"""
+	返回批量提交的计数:
+		batches: 提交次数, statements: 提交的语句数, mean_size/max_size: 每批的平均/最大语句数
+		commit_time/mean_commit_time/max_commit_time: 提交的累计/平均/最大耗时秒数
+	"""
+	with _batch_stats_lock:
+		d = Dict(**_batch_stats)
+	d.mean_size = float(d.statements) / d.batches if d.batches else 0.0
+	d.mean_commit_time = d.commit_time / d.batches if d.batches else 0.0
+	return d
+
+
+class _BatchCtx(object):
+	def __init__(self,max_statements,max_delay):
+		self.max_statements = max_statements
+		self.max_delay = max_delay
+		self.pending = 0
+		self.first = None
+
+	def __enter__(self):
+		global _db_ctx
+		self.should_close_conn = False
+		if not _db_ctx.is_init():
+			_db_ctx.init()
+			self.should_close_conn = True
+		self.outermost = _db_ctx.batch is None
+		if self.outermost:
+			_db_ctx.batch = self
+		return self
+
+	def __exit__(self,exctype,excvalue,traceback):
+		global _db_ctx
+		try:
+			if self.outermost:
+				self.flush()
+		finally:
+			if self.outermost:
+				_db_ctx.batch = None
+			if self.should_close_conn:
+				_db_ctx.cleanup()
+
+	def written(self):
+		"""
+		事务外执行了一条写语句,到达条数或时间上限时提交
+		"""
+		now = time.time()
+		self.pending += 1
+		if self.pending == 1:
+			self.first = now
+		if self.pending >= self.max_statements or now - self.first >= self.max_delay:
+			self.flush()
+
+	def flush(self):
+		global _db_ctx
+		if not self.pending:
+			return
+		size = self.pending
+		self.pending = 0
+		start = time.time()
+		try:
+			_db_ctx.connection.commit()
+		except:
+			logging.warning('commit batch failed. try rollback...')
+			_db_ctx.connection.rollback()
+			_db_ctx.rolled_back()
+			raise
+		elapsed = time.time() - start
+		_db_ctx.committed()
+		with _batch_stats_lock:
+			_batch_stats['batches'] += 1
+			_batch_stats['statements'] += size
+			_batch_stats['commit_time'] += elapsed
+			_batch_stats['max_size'] = max(_batch_stats['max_size'],size)
+			_batch_stats['max_commit_time'] = max(_batch_stats['max_commit_time'],elapsed)
+
+
+def _is_retryable(e):
+	return engine.driver.is_retryable(e)
+
+def retry_transaction(max_attempts=3,backoff=0.05,max_backoff=1.0):
+	"""
+	装饰器,在事务中执行函数,遇到死锁或锁等待超时时回滚并重新执行,最多执行max_attempts次
+	第n次重试前随机等待0到min(max_backoff, backoff*2**(n-1))秒,错开冲突的请求
+	已经在外层事务中时不重试:内层无法单独重做,异常交给外层处理
+	被装饰的函数可能执行多次,不要在其中做数据库以外的副作用
+	>>> import sqlite3
+	>>> calls = []
+	>>> @retry_transaction(backoff=0.001)
+	... def add_user():
+	...     calls.append(1)
+	...     n = insert('user', id=3100, name='Cain', email='cain@test.org', passwd='1', last_modified=0)
+	...     if len(calls) == 1:
+	...         raise sqlite3.OperationalError('database is locked')
+	>>> add_user()
+	>>> len(calls), select_int('select count(*) from user where id=3100')
+	(2, 1)
+	>>> update('delete from user where id=3100')
+	1
+	"""
+	def _decorator(func):
+		@functools.wraps(func)
+		def _wrapper(*args,**kw):
+			if _db_ctx.transactions:
+				with _TransactionCtx():
+					return func(*args,**kw)
+			attempt = 1
+			while True:
+				try:
+					with _TransactionCtx():
+						return func(*args,**kw)
+				except Exception, e:
+					if attempt >= max_attempts or not _is_retryable(e):
+						raise
+					delay = random.uniform(0,min(max_backoff,backoff * 2 ** (attempt - 1)))
+					logging.warning('[RETRY] %s failed: %s, retry %d/%d in %.3fs' % (func.__name__,e,attempt,max_attempts - 1,delay))
+					time.sleep(delay)
+					attempt += 1
+		return _wrapper
+	return _decorator
+
+def _is_disconnect(e):
+	return engine.driver.is_disconnect(e)
+
+
 def _select(sql,first,*args):
+	"""
+	不在事务中且未要求走主库时,查询发往副本;副本不可用时退回主库
+	"""
+	global _db_ctx
+	if _db_ctx.reads_from_replica():
+		replica = engine.replica()
+		if replica is not None:
+			r = _select_replica(replica, sql, first, args)
+			if r is not _UNAVAILABLE:
+				return r
+	return _select_primary(sql, first, *args)
+
+
+_UNAVAILABLE = object()
+
+def _select_replica(replica, sql, first, args):
+	try:
+		conn = replica.connect()
+	except PoolTimeoutError:
+		return _UNAVAILABLE
+	except Exception, e:
+		replica.mark_down(e)
+		return _UNAVAILABLE
+	try:
+		r = _fetch(conn, sql, first, args)
+	except Exception, e:
+		if not _is_disconnect(e):
+			replica.release(conn)
+			raise
+		replica.release(conn, discard=True)
+		replica.mark_down(e)
+		return _UNAVAILABLE
+	replica.release(conn)
+	return r
+
+
+@with_connection
+def _select_primary(sql,first,*args):
 	global _db_ctx
+	return _fetch(_db_ctx.connection, sql, first, args)
+
+
+def _fetch(connection, sql, first, args):
 	cursor = None
-	sql = sql.replace('?','%s')
-	logging.info('SQL: %s, ARGS: %s' % (sql, args))
+	stmt = connection.statement(sql)
 	try:
-		cursor = _db_ctx.connection.cursor()
-		cursor.execute(sql, args)
-		if cursor.description:
-			names = [x[0] for x in cursor.description]
-		if first:
-			values = cursor.fetchone()
-			if not values:
-				return None
-			return Dict(names, values)
-		return [Dict(names, x) for x in cursor.fetchall()]
+		cursor = stmt.cursor or connection.cursor()
+		if _hooked:
+			return _instrumented(connection, sql, args, _fetch_rows, cursor, stmt.sql, first, args)
+		return _fetch_rows(cursor, stmt.sql, first, args)
 	finally:
-		if cursor:
+		if cursor and cursor is not stmt.cursor:
 			cursor.close()
 
 
+def _fetch_rows(cursor, sql, first, args):
+	cursor.execute(sql, args)
+	if cursor.description:
+		row_class = _row_class([x[0] for x in cursor.description])
+	# 预处理游标不缓冲结果,必须读完才能执行下一条语句
+	rows = cursor.fetchall()
+	if first:
+		if not rows:
+			return None
+		return row_class(rows[0])
+	return map(row_class, rows)
+
+
 def select_one(sql, *args):
 	"""
 	执行SQL 仅返回一个结果
@@ -276,7 +1518,7 @@ def select_int(sql, *args):
 
 def select(sql, *args):
 	"""
-	执行sql 以列表形式返回结果
+	执行sql 以Row列表形式返回结果
 	>>> u1 = dict(id=200, name='Wall.E', email='wall.e@test.org', passwd='back-to-earth', last_modified=time.time())
 	>>> u2 = dict(id=201, name='Eva', email='eva@test.org', passwd='back-to-earth', last_modified=time.time())
 	>>> insert('user', **u1)
@@ -298,6 +1540,86 @@ def select(sql, *args):
 	return _select(sql, False, *args)
 
 
+def iter_select(sql, *args, **kw):
+	"""
+	流式执行sql,返回逐行生成结果的生成器,适合导出大表
+	使用不缓冲的游标,每次从服务端取batch_size行,内存占用与结果集大小无关
+	本线程没有打开连接上下文时,迭代期间独占一个从连接池借出的连接,迭代结束或生成器被关闭时归还;
+	在with connection()或事务中调用时直接使用上下文的连接,这样能读到事务中未提交的写入,
+	也不会在连接池上再等一个连接(sqlite内存数据库只有一个连接),
+	但迭代结束前本线程不能在这个连接上执行其他查询,提前关闭时会读完剩余的结果
+	>>> [u.name for u in iter_select('select * from user where id=?', 2000, batch_size=10)]
+	[u'Bob']
+	"""
+	batch_size = kw.pop('batch_size', 500)
+	if kw:
+		raise TypeError('Unexpected keyword arguments: %s' % ','.join(kw))
+	source = engine.replica() if _db_ctx.reads_from_replica() else None
+	conn = None
+	if source is not None:
+		# 和_select_replica一样,副本连不上时移出轮转,退回主库
+		try:
+			conn = source.connect()
+		except PoolTimeoutError:
+			source = None
+		except Exception, e:
+			source.mark_down(e)
+			source = None
+	if conn is None:
+		if _db_ctx.is_init():
+			conn = _db_ctx.connection
+		else:
+			source = engine
+			conn = source.connect()
+	cursor = None
+	exhausted = False
+	event = None
+	if _hooked:
+		# 耗时从执行到迭代结束,包含调用者处理每一行的时间
+		event = QueryEvent(sql, args, hex(id(conn)))
+		event.rows = 0
+		_run_hooks(_before_hooks, event)
+	try:
+		cursor = conn.cursor(buffered=False)
+		cursor.execute(_format(sql, engine.driver.placeholder), args)
+		row_class = _row_class([x[0] for x in cursor.description])
+		while True:
+			rows = cursor.fetchmany(batch_size)
+			if not rows:
+				break
+			if event is not None:
+				event.rows += len(rows)
+			for row in rows:
+				yield row_class(row)
+		exhausted = True
+	except Exception, e:
+		if event is not None:
+			event.error = e
+		if isinstance(source, _Replica) and _is_disconnect(e):
+			source.mark_down(e)
+		raise
+	finally:
+		if event is not None:
+			event.elapsed = time.time() - event.started
+			_run_hooks(_after_hooks, event)
+		if source is None:
+			# 上下文的连接还要继续使用,读完剩余的结果
+			if cursor:
+				try:
+					if not exhausted:
+						cursor.fetchall()
+				finally:
+					cursor.close()
+		else:
+			if cursor:
+				try:
+					cursor.close()
+				except Exception:
+					exhausted = False
+			# 提前关闭时连接上还有未读完的结果,不能再放回连接池
+			source.release(conn, discard=not exhausted)
+
+
 @with_connection
 def _update(sql, *args):
 	"""
@@ -305,22 +1627,33 @@ def _update(sql, *args):
 	"""
 	global _db_ctx
 	cursor = None
-	sql = sql.replace('?', '%s')
-	logging.info('SQL: %s, ARGS: %s' % (sql, args))
+	stmt = _db_ctx.connection.statement(sql)
 	try:
-		cursor = _db_ctx.connection.cursor()
-		cursor.execute(sql, args)
-		r = cursor.rowcount
+		cursor = stmt.cursor or _db_ctx.connection.cursor()
+		if _hooked:
+			r = _instrumented(_db_ctx.connection, sql, args, _execute, cursor, stmt.sql, args)
+		else:
+			r = _execute(cursor, stmt.sql, args)
+		if stmt.table:
+			_db_ctx.written.add(stmt.table)
 		if _db_ctx.transactions == 0:
 			# no transaction enviroment:
-			logging.info('auto commit')
-			_db_ctx.connection.commit()
+			if _db_ctx.batch is not None:
+				_db_ctx.batch.written()
+			else:
+				_db_ctx.connection.commit()
+				_db_ctx.committed()
 		return r
 	finally:
-		if cursor:
+		if cursor and cursor is not stmt.cursor:
 			cursor.close()
 
 
+def _execute(cursor, sql, args):
+	cursor.execute(sql, args)
+	return cursor.rowcount
+
+
 def update(sql, *args):
 	"""
 	执行update 语句，返回update的行数
@@ -354,7 +1687,7 @@ def insert(table, **kw):
 	>>> u2 = select_one('select * from user where id=?', 2000)
 	>>> u2.name
 	u'Bob'
-	>>> insert('user', **u2)
+	>>> insert('user', **u2) # doctest: +IGNORE_EXCEPTION_DETAIL
 	Traceback (most recent call last):
 	  ...
 	IntegrityError: 1062 (23000): Duplicate entry '2000' for key 'PRIMARY'
@@ -364,6 +1697,100 @@ def insert(table, **kw):
 	return _update(sql, *args)
 
 
+# MySQL 5.6.6之前max_allowed_packet的默认值,按它估算可以适配所有版本
+_MAX_PACKET = 1024 * 1024
+
+def insert_many(table, rows, batch_size=1000, max_packet=_MAX_PACKET, columns=None):
+	"""
+	批量执行insert语句,rows是字段相同的字典列表,返回插入的行数
+	给出columns时rows可以是与columns顺序一致的值序列,省去每行建字典
+	每批最多batch_size行,并按估算的语句长度拆分,保证不超过max_packet,
+	每批拼成一条多行VALUES的insert语句,所有批次在同一个事务中提交
+	>>> u1 = dict(id=3000, name='Tom', email='tom@test.org', passwd='tomtom', last_modified=time.time())
+	>>> u2 = dict(id=3001, name='Jerry', email='jerry@test.org', passwd='jerry', last_modified=time.time())
+	>>> insert_many('user', [u1, u2])
+	2
+	>>> select_int('select count(*) from user where id>=? and id<=?', 3000, 3001)
+	2
+	>>> update('delete from user where id>=? and id<=?', 3000, 3001)
+	2
+	"""
+	if not rows:
+		return 0
+	cols = list(columns) if columns else rows[0].keys()
+	driver = engine.driver
+	batch_size = max(1, min(batch_size, driver.max_params // len(cols)))
+	head = 'insert into `%s` (%s) values ' % (table, ','.join(['`%s`' % col for col in cols]))
+	group = '(%s)' % ','.join([driver.placeholder for col in cols])
+	return _insert_batches(table, _batches(head, group, cols, rows, batch_size, max_packet, columns is not None))
+
+
+def _batches(head, group, cols, rows, batch_size, max_packet, sequences=False):
+	"""
+	把rows切分成(sql, args),按值的长度估算每行在语句中的字节数
+	unicode按utf-8编码后的长度计算,一个汉字占3个字节;转义最多让长度翻倍
+	"""
+	n = len(cols)
+	args = []
+	count = 0
+	size = len(head)
+	for row in rows:
+		if len(row) != n:
+			raise DBError('Expect columns %s in every row.' % ','.join(cols))
+		values = list(row) if sequences else [row[col] for col in cols]
+		row_size = len(group) + 1
+		for v in values:
+			if isinstance(v, unicode):
+				row_size += len(v.encode('utf-8')) * 2
+			elif isinstance(v, str):
+				row_size += len(v) * 2
+			else:
+				row_size += 24
+		if count and (count >= batch_size or size + row_size > max_packet):
+			yield head + ','.join([group] * count), args
+			args = []
+			count = 0
+			size = len(head)
+		args.extend(values)
+		count += 1
+		size += row_size
+	if count:
+		yield head + ','.join([group] * count), args
+
+
+@with_connection
+def _insert_batches(table, batches):
+	"""
+	执行批量insert,不在事务中时所有批次只提交一次,出错则全部回滚
+	"""
+	global _db_ctx
+	cursor = None
+	r = 0
+	if _db_ctx.transactions == 0 and _db_ctx.batch is not None:
+		# 出错时要整体回滚,先提交批量中已有的语句
+		_db_ctx.batch.flush()
+	try:
+		cursor = _db_ctx.connection.cursor()
+		for sql, args in batches:
+			if _hooked:
+				r += _instrumented(_db_ctx.connection, sql, args, _execute, cursor, sql, args)
+			else:
+				r += _execute(cursor, sql, args)
+		_db_ctx.written.add(table)
+		if _db_ctx.transactions == 0:
+			_db_ctx.connection.commit()
+			_db_ctx.committed()
+		return r
+	except:
+		if _db_ctx.transactions == 0:
+			_db_ctx.connection.rollback()
+			_db_ctx.rolled_back()
+		raise
+	finally:
+		if cursor:
+			cursor.close()
+
+
 class Dict(dict):
 	"""
 	字典对象
@@ -384,6 +1811,102 @@ class Dict(dict):
 		self[key] = value
 
 
+class Row(object):
+	"""
+	查询结果中的一行,和Dict一样可以用row.key或row['key']访问
+	同一结果集的所有行属于同一个Row子类,共享一份 列名=>下标 的映射,
+	每行只保存驱动返回的值元组,不再为每行建一个字典
+	行是只读的,需要修改时用to_dict()转成Dict
+	"""
+	__slots__ = ('_values',)
+	_names = ()
+	_index = {}
+
+	def __init__(self, values):
+		self._values = values
+
+	def __getattr__(self, key):
+		try:
+			return self._values[self._index[key]]
+		except KeyError:
+			raise AttributeError(r"'Row' object has no attribute '%s'" % key)
+
+	def __getitem__(self, key):
+		return self._values[self._index[key]]
+
+	def get(self, key, default=None):
+		i = self._index.get(key)
+		return default if i is None else self._values[i]
+
+	def __contains__(self, key):
+		return key in self._index
+
+	has_key = __contains__
+
+	def __iter__(self):
+		return iter(self._names)
+
+	def __len__(self):
+		return len(self._names)
+
+	def __eq__(self, other):
+		if isinstance(other, Row):
+			return self._names == other._names and self._values == other._values
+		return dict(self.iteritems()) == other
+
+	def __ne__(self, other):
+		return not self == other
+
+	__hash__ = None
+
+	def keys(self):
+		return list(self._names)
+
+	def values(self):
+		return list(self._values)
+
+	def items(self):
+		return zip(self._names, self._values)
+
+	def iterkeys(self):
+		return iter(self._names)
+
+	def itervalues(self):
+		return iter(self._values)
+
+	def iteritems(self):
+		return itertools.izip(self._names, self._values)
+
+	def to_dict(self):
+		return Dict(self._names, self._values)
+
+	def __reduce__(self):
+		return (_make_row, (self._names, self._values))
+
+	def __repr__(self):
+		return '{%s}' % ', '.join(['%r: %r' % (k, v) for k, v in self.iteritems()])
+
+
+_row_classes = {}
+
+def _row_class(names):
+	"""
+	按列名取得(或创建)对应的Row子类,缓存的种类有上限,超过时清空重建
+	"""
+	names = tuple(names)
+	row_class = _row_classes.get(names)
+	if row_class is None:
+		if len(_row_classes) >= 512:
+			_row_classes.clear()
+		index = dict((name, i) for i, name in enumerate(names))
+		row_class = type('Row', (Row,), dict(__slots__=(), _names=names, _index=index))
+		_row_classes[names] = row_class
+	return row_class
+
+def _make_row(names, values):
+	return _row_class(names)(values)
+
+
 class DBError(Exception):
 	pass
 
@@ -391,8 +1914,16 @@ class DBError(Exception):
 class MultiColumnsError(DBError):
 	pass
 
+
+class PoolTimeoutError(DBError):
+	pass
+
 class _TransactionCtx(object):
-	def _enter_(self):
+	def __init__(self,savepoint=False):
+		self.savepoint = savepoint
+		self.name = None
+
+	def __enter__(self):
 		"""
 		每遇到一层事务嵌套+1
 		"""
@@ -401,35 +1932,80 @@ class _TransactionCtx(object):
 		if not _db_ctx.is_init():
 			_db_ctx.init()
 			self.should_close_conn = True
-		_db_ctx.transaction = _db_ctx.transacitons + 1
-		logging.info('begin transaction...' if _db_ctx.transactions == 1 else 'join current transaction...')
+		_db_ctx.transactions = _db_ctx.transactions + 1
+		if _db_ctx.transactions == 1:
+			if _db_ctx.batch is not None:
+				# 事务回滚时不能带走批量中已执行的语句
+				try:
+					_db_ctx.batch.flush()
+				except:
+					_db_ctx.transactions = _db_ctx.transactions - 1
+					if self.should_close_conn:
+						_db_ctx.cleanup()
+					raise
+			logging.info('begin transaction...')
+		elif self.savepoint:
+			# 同一深度同时只有一个保存点,按深度命名不会冲突
+			name = 'sp_%d' % _db_ctx.transactions
+			try:
+				self._execute('SAVEPOINT %s' % name)
+			except:
+				_db_ctx.transactions = _db_ctx.transactions - 1
+				if self.should_close_conn:
+					_db_ctx.cleanup()
+				raise
+			self.name = name
+			logging.info('begin savepoint %s...' % name)
+		else:
+			logging.info('join current transaction...')
 		return self
 
-	def _exit_(self,exctype,excvalue,traceback):
+	def __exit__(self,exctype,excvalue,traceback):
 		"""
 		离开一层事务嵌套-1,到0时离开
 		"""
 		global _db_ctx
 		_db_ctx.transactions = _db_ctx.transactions - 1
 		try:
-			if _db_ctx.transactions == 0:
+			if self.name is not None:
+				if exctype is None:
+					self._execute('RELEASE SAVEPOINT %s' % self.name)
+				else:
+					logging.warning('rollback to savepoint %s...' % self.name)
+					try:
+						self._execute('ROLLBACK TO SAVEPOINT %s' % self.name)
+					except Exception, e:
+						# 死锁或断线时整个事务已被回滚,保存点不存在了,
+						# 这个错误不能掩盖原来的异常,外层事务和retry_transaction要看到的是原来的错误
+						logging.warning('rollback to savepoint %s failed: %s' % (self.name,e))
+			elif _db_ctx.transactions == 0:
 				if exctype is None:
 					self.commit()
 				else:
 					self.rollback()
 		finally:
+			self.name = None
 			if self.should_close_conn:
 				_db_ctx.cleanup()
 
+	def _execute(self,sql):
+		cursor = _db_ctx.connection.cursor()
+		try:
+			cursor.execute(sql)
+		finally:
+			cursor.close()
+
 	def commit(self):
 		global _db_ctx
 		logging.info('commit transaction...')
 		try:
 			_db_ctx.connection.commit()
+			_db_ctx.committed()
 			logging.info('commit ok.')
 		except:
 			logging.warning('commit failed. try rollback...')
 			_db_ctx.connection.rollback()
+			_db_ctx.rolled_back()
 			logging.warning('rollback ok.')
 			raise
 
@@ -437,5 +2013,13 @@ class _TransactionCtx(object):
 		global _db_ctx
 		logging.warning('rollback transaction...')
 		_db_ctx.connection.rollback()
+		_db_ctx.rolled_back()
 		logging.info('rollback ok.')
 
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.WARNING)
+	create_engine(database=':memory:', driver='sqlite')
+	update('create table user (id bigint not null primary key, name varchar(100), email varchar(100), passwd varchar(100), last_modified real)')
+	import doctest
+	doctest.testmod()
@@ -31,11 +31,18 @@ orm模块设计原因:
 			最后 id/name 要变成user实例的属性
 """
 
+import base64
 import db
+import hashlib
+import json
 import logging
+import re
 
 _triggers = frozenset(['pre_insert','pre_updata','pre_delete'])
 
+# 类名 => Model子类,用于按名字解析Field(ref=...)声明的引用
+_models = {}
+
 class ModelMetaclass(type):
 	"""
 	对类对象动态完成以下操作
@@ -62,12 +69,18 @@ class ModelMetaclass(type):
 
 		logging.info('Scan ORMapping %s...' % name)
 		mappings = dict()
+		refs = dict()
 		primary_key = None
 		for k,v in attrs.iteritems():
 			if isinstance(v,Field):
 				if not v.name:
 					v.name = k
 				logging.info('[MAPPING] Found mapping: %s => %s' % (k,v))
+				if v.ref:
+					ref_name = v.ref_name or (k[:-3] if k.endswith('_id') else None)
+					if not ref_name:
+						raise TypeError('Cannot derive reference name from field %s, set ref_name.' % k)
+					refs[ref_name] = (k,v.ref)
 				if v.primary_key:
 					if primary_key:
 						raise TypeError('Cannot define more than 1 primary key in class: %s' % name)
@@ -82,13 +95,69 @@ class ModelMetaclass(type):
 			attrs.pop(k)
 		if not '__table__' in attrs:
 			attrs['__table__'] = name.lower()
+		indexes = []
+		for unique,declared in ((False,attrs.get('__indexes__',())),(True,attrs.get('__unique_indexes__',()))):
+			for cols in declared:
+				if isinstance(cols,basestring):
+					cols = (cols,)
+				for col in cols:
+					if col not in mappings:
+						raise TypeError('Index on unknown field %s in class: %s' % (col,name))
+				indexes.append((unique,tuple([mappings[col].name for col in cols])))
+		for f in sorted(mappings.values(),key=lambda f:f._order):
+			if f.index or f.unique:
+				indexes.append((f.unique,(f.name,)))
 		attrs['__mappings__'] = mappings
 		attrs['__primary_key__'] = primary_key
-		attrs['__sql__'] = lambda self:_gen_sql(attrs['__table__'],mappings)
+		attrs['__refs__'] = refs
+		versions = [k for k,f in mappings.iteritems() if isinstance(f,VersionField)]
+		if len(versions) > 1:
+			raise TypeError('Cannot define more than 1 version field in class: %s' % name)
+		attrs['__version__'] = versions[0] if versions else None
+		deferred = [f for f in mappings.itervalues() if f.deferred]
+		if deferred:
+			if primary_key.deferred:
+				raise TypeError('Primary key cannot be deferred in class: %s' % name)
+			columns = sorted([f for f in mappings.itervalues() if not f.deferred],key=lambda f:f._order)
+			attrs['__select_columns__'] = ','.join(['`%s`' % f.name for f in columns])
+		else:
+			attrs['__select_columns__'] = '*'
+		# 每次操作都要用到的sql和字段列表在这里一次算好,调用时只需绑定参数
+		table = attrs['__table__']
+		pk = primary_key.name
+		ordered = sorted(mappings.iteritems(),key=lambda kv:kv[1]._order)
+		insertable = tuple([(k,f) for k,f in ordered if f.insertable])
+		attrs['__insertable__'] = insertable
+		attrs['__insert_columns__'] = tuple([f.name for k,f in insertable])
+		attrs['__updatable__'] = tuple([(k,f) for k,f in ordered if f.updatable and k != attrs['__version__']])
+		attrs['__get_sql__'] = 'select * from `%s` where `%s`=?' % (table,pk)
+		attrs['__find_sql__'] = 'select %s from `%s` ' % (attrs['__select_columns__'],table)
+		attrs['__count_sql__'] = 'select count(`%s`) from `%s` ' % (pk,table)
+		attrs['__insert_sql__'] = 'insert into `%s` (%s) values (%s)' % (table,
+				','.join(['`%s`' % f.name for k,f in insertable]),','.join(['?'] * len(insertable)))
+		attrs['__delete_sql__'] = 'delete from `%s` where `%s`=?' % (table,pk)
+		attrs['__update_sqls__'] = dict()
+		attrs['__sql__'] = lambda self,dialect=None:_gen_sql(attrs['__table__'],mappings,indexes,dialect)
 		for trigger in _triggers:
 			if not trigger in attrs:
 				attrs[trigger] = None
-		return type.__new__(cls,name,bases,attrs)
+		model = type.__new__(cls,name,bases,attrs)
+		_models[name] = model
+		return model
+
+class _ClassOrInstanceMethod(object):
+	"""
+	在类上访问时是classmethod,在实例上访问时是普通方法:
+	Model.get(pk)按主键查询,实例的get(key,default)保持dict的语义并加载延迟的列
+	"""
+	def __init__(self,on_class,on_instance):
+		self.on_class = on_class
+		self.on_instance = on_instance
+
+	def __get__(self,inst,owner):
+		if inst is None:
+			return self.on_class.__get__(None,owner)
+		return self.on_instance.__get__(inst,owner)
 
 class Model(dict):
 	"""
@@ -99,20 +168,37 @@ class Model(dict):
 		"__table__":表名
 		"__mappings__":字段对象(字段的所有属性,见Field类)
 		"__primary_key__":主键字段
-		"__sql__":创建表时执行的sql
+		"__refs__":引用名 => (字段名,被引用的类名),由Field(ref='User')声明,
+			引用名缺省为去掉_id后缀的字段名,比如user_id => user
+		"__sql__":创建表时执行的sql,包括Field(index=True/unique=True)声明的单列索引,
+			以及类属性__indexes__/__unique_indexes__声明的组合索引,比如
+			__indexes__ = [('blog_id','created_at')]
+			dialect缺省取当前engine的驱动,sqlite时索引用单独的create index语句创建
+		"__version__":VersionField字段名,用于updata时的乐观锁检查,没有时为None
+		"__select_columns__":find_*缺省查询的列,不含Field(deferred=True)声明的延迟加载列
+		"__get_sql__"/"__find_sql__"/"__count_sql__"/"__insert_sql__"/"__delete_sql__":预先生成的sql
+		"__insertable__"/"__updatable__":按定义顺序排列的(属性名,字段)元组
+		"__update_sqls__":按要写入的列缓存的update语句
+		"__cache__":可选的主键缓存(见cache模块),设置后get先查缓存,insert/updata/delete时让缓存失效
+		"__query_cache__":可选的查询缓存,缓存find_by/count_by的结果,表有写入提交后失效
 
 	子类在实例化时需要完成 实例属性 <==>行值 的映射,这里使用 定制dict 来实现.
 		model 从字典继承而来,而且通过"__getattr__","__setattr__"将Model重写,
 		使得其像javaspript的object对象那样,可以通过属性访问 比如a.key = value
+	延迟加载和没有查询的列在a.key,a[key],a.get(key)时才加载,
+	遍历,keys()/items(),in和json.dumps(a)只包含已加载的列,需要完整内容时先访问一次这些列或用get(pk)查询
 	"""
 	__metaclass__ = ModelMetaclass
+	__cache__ = None
+	__query_cache__ = None
 
 	def __init__(self,**kw):
 		super(Model,self).__init__(**kw)
+		self.__dict__['_dirty'] = set(kw)
 
 	def __getattr__(self,key):
 		"""
-		get时生效,比如a[key],a.get(key)
+		get时生效,比如a.key
 		get时 返回属性的值
 		"""
 		try:
@@ -120,6 +206,22 @@ class Model(dict):
 		except KeyError:
 			raise AttributeError(r"Dict object has no attribute `%s`" % key)
 
+	def __missing__(self,key):
+		"""
+		a[key]找不到时由dict调用,已加载的列不经过这里
+		"""
+		loader = self.__dict__.get('_loader')
+		if loader is not None and key in self.__mappings__:
+			loader.load(key)
+			return dict.__getitem__(self,key)
+		raise KeyError(key)
+
+	def _get_value(self,key,default=None):
+		try:
+			return self[key]
+		except KeyError:
+			return default
+
 	def __setattr__(self,key,value):
 		"""
 		set时生效,比如a[key] = value,a = {'key1':value,'key2':value}
@@ -127,31 +229,228 @@ class Model(dict):
 		"""
 		self[key] = value
 
+	def __setitem__(self,key,value):
+		"""
+		记录被赋值过的字段,updata时只写这些字段
+		dict自带的update/setdefault/pop等方法不经过这里,不会被记录
+		"""
+		dict.__setitem__(self,key,value)
+		dirty = self.__dict__.get('_dirty')
+		if dirty is None:
+			self.__dict__['_dirty'] = set([key])
+		else:
+			dirty.add(key)
+
+	@classmethod
+	def _from_row(cls,row):
+		"""
+		直接用db.Row中的列名和值填充实例,不经过中间的字典
+		"""
+		inst = cls.__new__(cls)
+		dict.__init__(inst,row.iteritems())
+		# 行本身就是只读的,直接作为加载时的快照
+		inst.__dict__['_loaded'] = row
+		return inst
+
+	@classmethod
+	def _from_rows(cls,rows,columns):
+		"""
+		把查询结果转成实例,没有查询全部列时,让这批实例共享一个_Loader,
+		之后访问未加载的字段时一次性为整批实例补上
+		"""
+		L = map(cls._from_row,rows)
+		if columns != '*' and L:
+			loader = _Loader(cls,L)
+			for inst in L:
+				inst.__dict__['_loader'] = loader
+		return L
+
+	@classmethod
+	def _columns(cls,fields=None):
+		if fields is None:
+			return cls.__select_columns__
+		pk = cls.__primary_key__.name
+		for f in fields:
+			if f not in cls.__mappings__:
+				raise AttributeError('%s has no field named `%s`' % (cls.__name__,f))
+		return ','.join(['`%s`' % f for f in [pk] + [f for f in fields if f != pk]])
+
 	@classmethod
 	def get(cls,pk):
-		d = db.select_one('select * from %s where %s=?' % (cls.__table__,cls.__primary_key__.name),pk)
-		return cls(**d) if d else None
+		"""
+		按主键查询,类属性__cache__设置了缓存时先查缓存
+		按主键查询通常是为了显示详情,因此包括延迟加载的列
+		事务中或有未提交的写入时不读也不写缓存,直接查询数据库
+		未命中时从主库读取,副本可能还没同步到刚提交的写入;
+		查询期间表有提交(版本号变了)时,读到的可能是提交前的旧行,
+		写入缓存后再检查一次版本号,变了就删掉:提交方先增加版本号再删除缓存,
+		两者无论怎样交错,旧行都不会留在缓存中
+		"""
+		cache = cls.__cache__
+		if cache is None or db.uncommitted():
+			return cls._load(pk)
+		key = cls._cache_key(pk)
+		d = cache.get(key)
+		if d is not None:
+			return cls._from_row(d)
+		version = db.table_version(cls.__table__)
+		with db.use_primary():
+			d = db.select_one(cls.__get_sql__,pk)
+		if d:
+			cache.set(key,dict(d.iteritems()))
+			if db.table_version(cls.__table__) != version:
+				cache.delete(key)
+		return cls._from_row(d) if d else None
+
+	@classmethod
+	def _load(cls,pk):
+		d = db.select_one(cls.__get_sql__,pk)
+		return cls._from_row(d) if d else None
+
+	get = _ClassOrInstanceMethod(get,_get_value)
+
+	@classmethod
+	def _cache_key(cls,pk):
+		return '%s:%s' % (cls.__table__,pk)
+
+	def _invalidate(self):
+		"""
+		写入提交后删除缓存中的这一行,下次get时重新从数据库读取
+		直接用db.update修改表时不会经过这里,需要自己调用__cache__.delete
+		"""
+		cache = self.__cache__
+		if cache is not None:
+			key = self._cache_key(self[self.__primary_key__.name])
+			db.on_commit(lambda: cache.delete(key))
 
 	@classmethod
 	def find_first(cls,where,*args):
-		d = db.select_one('select * from %s %s' % (cls.__table__,where),*args)
-		return cls(**d) if d else None
+		columns = cls.__select_columns__
+		d = db.select_one('select %s from %s %s' % (columns,cls.__table__,where),*args)
+		return cls._from_rows([d],columns)[0] if d else None
 
 	@classmethod
 	def find_all(cls,*args):
 		"""
-		查询所有字段,将结果以一个列表返回
+		查询所有字段(延迟加载的除外),将结果以一个列表返回
 		"""
-		L = db.select('select * from `%s`' % cls.__table__)
-		return [cls(**d) for d in L]
+		columns = cls.__select_columns__
+		L = db.select('select %s from `%s`' % (columns,cls.__table__))
+		return cls._from_rows(L,columns)
 
 	@classmethod
-	def find_by(cls,where,*args):
+	def find_by(cls,where,*args,**kw):
 		"""
 		通过where语法进行查询 结果以列表形式返回
+		设置了__query_cache__时结果会被缓存,可传入ttl指定本次结果缓存的秒数
+		可传入prefetch=('user',)同时批量加载引用的对象,见prefetch
+		可传入fields=['name','summary']只查询这些列(总会包括主键),
+		未查询的列和延迟加载的列一样,在第一次访问时为整批实例一次性加载
 		"""
-		L = db.select('select *from `%s` %s' % (cls.__table__,where),*args)
-		return [cls(**d) for d in L]
+		fields = kw.get('fields')
+		if fields is None:
+			columns = cls.__select_columns__
+			sql = cls.__find_sql__ + where
+		else:
+			columns = cls._columns(fields)
+			sql = 'select %s from `%s` %s' % (columns,cls.__table__,where)
+		if _advisor is not None:
+			_advise(cls.__table__,where,sql,args)
+		if cls.__query_cache__ is None:
+			L = db.select(sql,*args)
+		else:
+			L = cls._cached_query(sql,args,kw.get('ttl'),lambda:db.select(sql,*args))
+		L = cls._from_rows(L,columns)
+		if kw.get('prefetch'):
+			cls.prefetch(L,*kw['prefetch'])
+		return L
+
+	@classmethod
+	def prefetch(cls,instances,*names,**kw):
+		"""
+		批量加载实例引用的对象,避免逐个调用get产生N+1次查询
+		每个引用只执行 where pk in (...) 查询,主键超过chunk_size个时分批查询
+		加载的对象挂在实例的同名属性上,不放进字典,因此不会被写回数据库
+			comments = Comment.find_by('where blog_id=?', blog_id)
+			Comment.prefetch(comments, 'user')
+			comments[0].user.name
+		引用的对象不存在时属性值为None
+		"""
+		chunk_size = kw.get('chunk_size',_IN_CHUNK)
+		for name in names:
+			if name not in cls.__refs__:
+				raise AttributeError('%s has no reference named `%s`' % (cls.__name__,name))
+			field,target = cls.__refs__[name]
+			target = _models[target]
+			pk = target.__primary_key__.name
+			ids = list(set([inst[field] for inst in instances if dict.get(inst,field) is not None]))
+			related = dict()
+			for i in range(0,len(ids),chunk_size):
+				chunk = ids[i:i+chunk_size]
+				for obj in target.find_by('where `%s` in (%s)' % (pk,','.join(['?'] * len(chunk))),*chunk):
+					related[obj[pk]] = obj
+			for inst in instances:
+				inst.__dict__[name] = related.get(dict.get(inst,field))
+		return instances
+
+	@classmethod
+	def iter_by(cls,where,*args,**kw):
+		"""
+		与find_by相同,但逐个生成实例而不是返回列表,可传入batch_size
+		用于遍历大表,内存占用不随表的大小增长
+		遍历通常是为了导出整行,因此包括延迟加载的列
+		"""
+		it = db.iter_select('select * from `%s` %s' % (cls.__table__,where),*args,**kw)
+		try:
+			for d in it:
+				yield cls._from_row(d)
+		finally:
+			it.close()
+
+	@classmethod
+	def page_after(cls,order_field,token,limit,where='',*args):
+		"""
+		键集分页,按(order_field,主键)升序取token之后的limit个实例
+		token为None时取第一页,返回(实例列表,下一页的token),没有更多数据时token为None
+		where是不带where关键字的过滤条件:
+			blogs,token = Blog.page_after('created_at',None,20,'user_id=?',uid)
+			more,token = Blog.page_after('created_at',token,20,'user_id=?',uid)
+		不使用limit offset,翻到多深都是一次索引范围扫描,和第一页代价相同,
+		需要(order_field,主键)上有索引
+		"""
+		return cls._page(order_field,token,limit,where,args,'>','asc')
+
+	@classmethod
+	def page_before(cls,order_field,token,limit,where='',*args):
+		"""
+		与page_after相同,但按(order_field,主键)降序取token之前的实例,
+		比如按created_at从新到旧翻页
+		"""
+		return cls._page(order_field,token,limit,where,args,'<','desc')
+
+	@classmethod
+	def _page(cls,order_field,token,limit,where,args,op,direction):
+		if order_field not in cls.__mappings__:
+			raise AttributeError('%s has no field named `%s`' % (cls.__name__,order_field))
+		pk = cls.__primary_key__.name
+		conds = []
+		params = []
+		if where:
+			conds.append('(%s)' % where)
+			params.extend(args)
+		if token is not None:
+			value,last = _decode_token(token)
+			# 前半部分的比较让数据库可以从索引上直接定位到起始位置
+			conds.append('`%s` %s= ? and (`%s` %s ? or `%s` %s ?)' % (order_field,op,order_field,op,pk,op))
+			params.extend([value,value,last])
+		params.append(limit)
+		columns = cls.__select_columns__
+		sql = 'select %s from `%s` %s order by `%s` %s,`%s` %s limit ?' % (columns,cls.__table__,
+				'where %s' % ' and '.join(conds) if conds else '',order_field,direction,pk,direction)
+		L = cls._from_rows(db.select(sql,*params),columns)
+		if len(L) < limit:
+			return L,None
+		return L,_encode_token(L[-1][order_field],L[-1][pk])
 
 	@classmethod
 	def count_all(cls):
@@ -161,54 +460,236 @@ class Model(dict):
 		return db.select('select count(`%s`) from `%s`' % (cls.__primary_key__.name,cls.__table__))
 
 	@classmethod
-	def count_by(cls,where,*args):
+	def count_by(cls,where,*args,**kw):
 		"""
 		通过select count(pk) from table where...进行查询,返回一个数值
+		和find_by一样可以使用__query_cache__缓存结果
 		"""
-		return db.select_int('select count(`%s`) from `%s` %s' % (cls.__primary_key__.name,cls.__table__,where),*args)
+		sql = cls.__count_sql__ + where
+		if _advisor is not None:
+			_advise(cls.__table__,where,sql,args)
+		if cls.__query_cache__ is None:
+			return db.select_int(sql,*args)
+		return cls._cached_query(sql,args,kw.get('ttl'),lambda:db.select_int(sql,*args))
 
-	def updata(self):
+	@classmethod
+	def _cached_query(cls,sql,args,ttl,load):
+		"""
+		以(表,查询前表的版本号,sql,参数)为键缓存load()的结果,
+		表的版本号变了(本进程有写入该表的提交)就换了键,旧结果按未命中统计,由LRU或ttl淘汰
+		只跟踪本表的版本,where中用子查询关联其他表时需要靠ttl控制过期
+		事务中或有未提交的写入时结果可能被回滚,也可能包含本线程自己的写入,不读也不写缓存
+		未命中时从主库读取,否则落后的副本的结果会被缓存在提交后的新版本号下
+		"""
+		if db.uncommitted():
+			return load()
+		cache = cls.__query_cache__
+		key = '%s:%d:%s' % (cls.__table__,db.table_version(cls.__table__),hashlib.md5(repr((sql,args))).hexdigest())
+		r = cache.get(key)
+		if r is not None:
+			return r
+		with db.use_primary():
+			r = load()
+		cache.set(key,r,ttl)
+		return r
+
+	def updata(self,check_version=True):
+		"""
+		只写入赋值过且与加载时不同的可更新字段,没有改动时不访问数据库
+		模型声明了VersionField时做乐观锁检查:
+			update ... set ...,`version`=`version`+1 where pk=? and `version`=?
+		没有更新到行说明已被其他人修改,抛出StaleObjectError
+		check_version=False时去掉where中的版本条件,但版本号照样加1,
+		持有旧版本号的其他实例之后写入时仍会发现冲突
+		"""
 		self.pre_updata and self.pre_updata()
-		L = []
+		dirty = self.__dict__.get('_dirty')
+		if not dirty:
+			return self
+		loaded = self.__dict__.get('_loaded')
+		version = self.__version__
+		cols = []
 		args = []
-		for k,v in self.__mappings__.iteritems():
-			if v.updatable:
-				if hasattr(self,k):
-					arg = getattr(self,k)
-				else:
-					arg = v.default
-					setattr(self,k,arg)
-				L = append('`%s`=?' % k)
+		for k,f in self.__updatable__:
+			if k in dirty:
+				arg = self[k]
+				if loaded is not None and k in loaded and loaded[k] == arg:
+					continue
+				cols.append(f.name)
 				args.append(arg)
+		if not cols:
+			return self
 		pk = self.__primary_key__.name
-		args.append(getattr(self,pk))
-		db.updata('updata `%s` set %s where %s = ?' % (self.__table__,','.join(L),pk), *args)
+		args.append(self[pk])
+		check = version and check_version
+		if version:
+			current = self[version]
+			if check:
+				args.append(current)
+		r = db.update(self._update_sql(tuple(cols),version,check), *args)
+		if version:
+			if check and r == 0:
+				raise StaleObjectError('%s %s was modified by someone else.' % (self.__class__.__name__,self[pk]))
+			dict.__setitem__(self,version,current + 1)
+		self._mark_clean()
+		self._invalidate()
 		return self
 
+	@classmethod
+	def _update_sql(cls,cols,version,check=True):
+		key = (cols,version,check)
+		sql = cls.__update_sqls__.get(key)
+		if sql is None:
+			L = ['`%s`=?' % col for col in cols]
+			where = '`%s`=?' % cls.__primary_key__.name
+			if version:
+				L.append('`%s`=`%s`+1' % (version,version))
+				if check:
+					where = '%s and `%s`=?' % (where,version)
+			sql = 'update `%s` set %s where %s' % (cls.__table__,','.join(L),where)
+			# 可能的列组合很多时不再缓存,避免无限增长
+			if len(cls.__update_sqls__) < 256:
+				cls.__update_sqls__[key] = sql
+		return sql
+
+	def _mark_clean(self):
+		"""
+		写入后以当前的值作为新的快照
+		"""
+		self.__dict__['_loaded'] = dict(self)
+		self.__dict__['_dirty'] = set()
+
 	def delete(self):
 		"""
 		通过db对象的updata接口 执行sql
 			sql:delete from `user` where `id` = %s,ARGS:(10190,)
 		"""
 		self.pre_delete and self.pre_delete()
-		pk = self.__primary_key__.name
-		args = (getattr(self,pk),)
-		db.updata('delete from `%s` where `%s`=?' % (self.__table__,pk),*args)
+		db.update(self.__delete_sql__,self[self.__primary_key__.name])
+		self._invalidate()
 		return self
 
 	def insert(self):
 		"""
 		"""
-		self.pre_insert and self.pre_insert()
-		params = {}
-		for k,v in self.__mappings__.iteritems():
-			if v.insertable:
-				if not hasattr(self,k):
-					setattr(self,k,v.default)
-				params[v.name] = getattr(self,k)
-		db.insert('%s' % self.__table__,**params)
+		db.update(self.__insert_sql__,*self._insert_values())
+		self._mark_clean()
+		self._invalidate()
 		return self
 
+	@classmethod
+	def insert_all(cls,instances,batch_size=1000):
+		"""
+		批量插入,每个实例都像insert一样执行pre_insert并填入缺省值,
+		然后通过db.insert_many分批写入,所有行在同一个事务中提交
+		"""
+		rows = [inst._insert_values() for inst in instances]
+		db.insert_many(cls.__table__,rows,batch_size,columns=cls.__insert_columns__)
+		for inst in instances:
+			inst._mark_clean()
+			inst._invalidate()
+		return instances
+
+	def _insert_values(self):
+		"""
+		执行pre_insert,填入缺省值,返回与__insert_columns__顺序一致的值列表
+		"""
+		self.pre_insert and self.pre_insert()
+		values = []
+		for k,f in self.__insertable__:
+			if k in self:
+				values.append(self[k])
+			else:
+				v = f.default
+				dict.__setitem__(self,k,v)
+				values.append(v)
+		return values
+
+# where pk in (...) 每次最多带的主键个数
+_IN_CHUNK = 500
+
+class _Loader(object):
+	"""
+	同一次查询得到的实例共享一个_Loader,
+	第一次访问某个没有查询的列时,用 where pk in (...) 为这批实例一次性补上该列
+	"""
+	def __init__(self,model,instances):
+		self.model = model
+		self.instances = instances
+
+	def load(self,key):
+		model = self.model
+		pk = model.__primary_key__.name
+		missing = [inst for inst in self.instances if key not in inst]
+		ids = [inst[pk] for inst in missing]
+		values = dict()
+		for i in range(0,len(ids),_IN_CHUNK):
+			chunk = ids[i:i+_IN_CHUNK]
+			sql = 'select `%s`,`%s` from `%s` where `%s` in (%s)' % (pk,key,model.__table__,pk,','.join(['?'] * len(chunk)))
+			for r in db.select(sql,*chunk):
+				values[r[pk]] = r[key]
+		for inst in missing:
+			dict.__setitem__(inst,key,values.get(inst[pk]))
+
+# 缺失索引检查,开发时打开
+_advisor = None
+
+def enable_index_advisor(enabled=True):
+	"""
+	开发模式下打开缺失索引检查:find_by/count_by的每种查询(where子句中的数字字面量视为参数)
+	第一次出现时执行一次EXPLAIN,发现全表扫描就打印警告,并按查询形态统计调用次数
+	不要在生产环境打开,每种新查询都会多一次EXPLAIN
+	"""
+	global _advisor
+	_advisor = dict() if enabled else None
+
+def index_advisor_report():
+	"""
+	返回统计结果,全表扫描的查询排在前面,其次按调用次数排序:
+	[{'table':'comments','where':'where blog_id=?','count':120,'full_scan':True,'plan':[...]}]
+	"""
+	if _advisor is None:
+		return []
+	return sorted(_advisor.values(),key=lambda x:(not x.full_scan,-x.count))
+
+_RE_NUMBER = re.compile(r'\b\d+\b')
+
+def _advise(table,where,sql,args):
+	shape = (table,_RE_NUMBER.sub('?',where))
+	entry = _advisor.get(shape)
+	if entry is None:
+		sqlite = db.engine.driver.dialect == 'sqlite'
+		try:
+			plan = db.select('explain %s%s' % ('query plan ' if sqlite else '',sql),*args)
+		except Exception, e:
+			logging.warning('[INDEX] explain failed for %s: %s' % (sql,e))
+			plan = []
+		if sqlite:
+			# sqlite的全表扫描是'SCAN comments'或'SCAN TABLE comments',走索引时带USING
+			full_scan = any([p.detail.startswith('SCAN') and 'USING' not in p.detail for p in plan])
+		else:
+			full_scan = any([p.get('type') == 'ALL' for p in plan])
+		if full_scan:
+			logging.warning('[INDEX] full table scan on `%s`: %s' % (table,shape[1]))
+		entry = _advisor[shape] = db.Dict(table=table,where=shape[1],count=0,full_scan=full_scan,plan=plan)
+	entry.count += 1
+
+def _encode_token(value,pk):
+	"""
+	把翻页位置编码成不透明的字符串,调用者原样传回即可
+	"""
+	return base64.urlsafe_b64encode(json.dumps([value,pk]))
+
+def _decode_token(token):
+	try:
+		value,pk = json.loads(base64.urlsafe_b64decode(str(token)))
+	except (TypeError,ValueError):
+		raise ValueError('Invalid page token: %r' % token)
+	return value,pk
+
+class StaleObjectError(db.DBError):
+	pass
+
 class Field(object):
 	"""
 	保存数据库中表的 字段属性
@@ -216,18 +697,26 @@ class Field(object):
 	_count:类属性,每实例化一次该值+1
 	self._order:实例属性,实例化时从类属性处得到,用于记录该实例的第多少个实例
 	self._defalt:用于让orm自己填入缺省值,缺省值可以可调用对象,比如函数
+	self.ref:引用的Model类名,比如ref='User',配合Model.prefetch批量加载
+	self.deferred:延迟加载,find_*缺省不查询该列,第一次访问时再批量加载,适合大的文本列
 	其他实例属性都是用于描述字段属性
 	"""
 	_count = 0
 
 	def __init__(self,**kw):
 		self.name = kw.get('name',None)
-		self._default = kw.get('_default')
+		self._default = kw.get('default')
+		self._default_factory = self._default if callable(self._default) else None
 		self.primary_key = kw.get('primary_key',False)
 		self.nullable = kw.get('nullable',False)
 		self.updatable = kw.get('updatable',True)
 		self.insertable = kw.get('insertable',True)
 		self.ddl = kw.get('ddl','')
+		self.ref = kw.get('ref')
+		self.ref_name = kw.get('ref_name')
+		self.index = kw.get('index',False)
+		self.deferred = kw.get('deferred',False)
+		self.unique = kw.get('unique',False)
 		self._order = Field._count
 		Field._count += 1
 
@@ -236,8 +725,8 @@ class Field(object):
 		"""
 		利用getter实现的一个写保护的实例属性
 		"""
-		d = self._default
-		return d() if callable(d) else d
+		factory = self._default_factory
+		return factory() if factory is not None else self._default
 
 	def __str(self):
 		"""
@@ -324,10 +813,16 @@ class VersionField(Field):
 		super(VersionField, self).__init__(name = name,default = 0,ddl = 'bigint')
 
 
-def _gen_sql(table_name, mappings):
+def _gen_sql(table_name, mappings, indexes=(), dialect=None):
 	"""
 	类 ==> 表时 生成创建表的sql
+	indexes是(是否唯一,字段名元组)的列表
+	dialect为'sqlite'时不支持在create table中声明索引,改为在其后逐条create index,
+	sqlite的索引名在整个库中唯一,因此加上表名
 	"""
+	if dialect is None:
+		dialect = db.engine.driver.dialect if db.engine else 'mysql'
+
 	pk = None
 	sql = ['-- generating SQL for %s:' % table_name, 'create table `%s` (' % table_name]
 	for f in sorted(mappings.values(), lambda x, y: cmp(x._order, y._order)):
@@ -339,7 +834,18 @@ def _gen_sql(table_name, mappings):
 			pk = f.name
 		#sql.append(nullable and '  `%s` %s,' % (f.name, ddl) or '  `%s` %s not null,' % (f.name, ddl))
 		sql.append('  `%s` %s,' % (f.name, ddl) if nullable else '  `%s` %s not null,' % (f.name, ddl))
-	sql.append('  primary key(`%s`)' % pk)
+	keys = ['  primary key(`%s`)' % pk]
+	if dialect == 'sqlite':
+		sql.append(keys[0])
+		sql.append(');')
+		for unique, cols in indexes:
+			sql.append('create %s `%s_%s_%s` on `%s` (%s);' % ('unique index' if unique else 'index', 'uk' if unique else 'idx',
+					table_name, '_'.join(cols), table_name, ','.join(['`%s`' % col for col in cols])))
+		return '\n'.join(sql)
+	for unique, cols in indexes:
+		keys.append('  %s `%s_%s` (%s)' % ('unique key' if unique else 'key', 'uk' if unique else 'idx',
+				'_'.join(cols), ','.join(['`%s`' % col for col in cols])))
+	sql.append(',\n'.join(keys))
 	sql.append(');')
 	return '\n'.join(sql)
 
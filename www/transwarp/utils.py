@@ -0,0 +1,60 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+web模块用到的字符串转换工具
+http传输的是utf-8编码的str,python代码中使用unicode,这里负责两者之间的转换
+"""
+
+import urllib
+
+
+def to_str(s):
+	"""
+	转换成utf-8编码的str
+	>>> to_str(u'\u4e2d\u6587')
+	'\\xe4\\xb8\\xad\\xe6\\x96\\x87'
+	>>> to_str(123)
+	'123'
+	"""
+	if isinstance(s, str):
+		return s
+	if isinstance(s, unicode):
+		return s.encode('utf-8')
+	return str(s)
+
+
+def to_unicode(s, encoding='utf-8'):
+	"""
+	把str解码成unicode
+	>>> to_unicode('\\xe4\\xb8\\xad\\xe6\\x96\\x87') == u'\u4e2d\u6587'
+	True
+	"""
+	if isinstance(s, unicode):
+		return s
+	return s.decode(encoding)
+
+
+def quote(s, encoding='utf-8'):
+	"""
+	url编码,unicode先按encoding编码
+	>>> quote(u'a b')
+	'a%20b'
+	"""
+	if isinstance(s, unicode):
+		s = s.encode(encoding)
+	return urllib.quote(s)
+
+
+def unquote(s, encoding='utf-8'):
+	"""
+	url解码并返回unicode
+	>>> unquote('a%20b')
+	u'a b'
+	"""
+	return urllib.unquote(s).decode(encoding)
+
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
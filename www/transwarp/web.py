@@ -30,19 +30,31 @@ web框架概要
 
 设计web框架接口:
 	1.url路由:用于url到处理函数的映射
+		用@get/@post装饰处理函数,路径中的:name段匹配任意一段,按顺序作为参数传入
+		例子:
+			@get('/blog/:id')
+			def blog(id):
+				return 'blog %s' % id
+			wsgi = WSGIApplication()
+			wsgi.add_url(blog)
+		不带参数的路径放在字典中一次查到,带参数的路径按'/'分段放进前缀树,
+		路径存在但方法不对时返回405并带上Allow头,路径不存在时返回404
 	2.url截拦:用于根据url做权限检测
 	3.视图:用于html页面生成
 	4.数据模型:用于抽取数据(model.py)
 	5.事物数据:request数据和response数据的封装(threadlocal)
+	6.静态文件:WSGIApplication给出document_root时,/static/下的路径和/favicon.ico由StaticFiles处理,
+		文件用wsgi.file_wrapper(服务器支持时走sendfile)或按块流式输出,支持ETag,304和Range
 """
 
-import types,os,re,cgi,sys,time,datatime,functools,mimetypes,threading,logging,traceback,urllib
+import types,os,re,cgi,sys,time,datetime,functools,mimetypes,threading,logging,traceback,urllib,urlparse,json,tempfile,stat,calendar
+from email.utils import formatdate,parsedate
 
 from db import Dict
 import utils
 
 try:
-	from cStringIO import cStringIO
+	from cStringIO import StringIO
 except ImportError:
 	from StringIO import StringIO
 
@@ -117,6 +129,10 @@ _RESPONSE_STATUSES = {
     510: 'Not Extended',
 }
 
+# 状态行在导入时拼好,处理请求时直接查表
+_STATUS_LINES = dict((code, '%d %s' % (code, msg)) for code, msg in _RESPONSE_STATUSES.iteritems())
+_STATUS_LINE_SET = frozenset(_STATUS_LINES.itervalues())
+
 _RESPONSE_HEADERS = (
     'Accept-Ranges',
     'Age',
@@ -170,23 +186,23 @@ class _HttpError(Exception):
 		Init an HttpError with response code.
 		"""
 		super(_HttpError,self).__init__()
-		self.status = '%d %s' % (code,_RESPONSE_STATUSES[code])
-		self._headers = None 
+		self.status = _STATUS_LINES[code]
+		self._headers = None
 
 	def header(self,name,value):
 		"""
-		添加header,如果header为空则添加power by header
+		添加错误响应特有的header,X-Powered-By等公共header由Response提供
 		"""
 		if not self._headers:
-			self._headers = [_HEADER_X_POWERED_BY]
+			self._headers = []
 		self._headers.append((name,value))
 
 	@property
-	def headers(self,name,value):
+	def headers(self):
 		"""
 		使用setter方法实现的header属性
 		"""
-		if hasattr(self,'_headers'):
+		if self._headers:
 			return self._headers
 		return []
 
@@ -195,6 +211,18 @@ class _HttpError(Exception):
 
 	__repr__ = __str__
 
+class _FrozenHttpError(_HttpError):
+	"""
+	不带header的常用错误(400,404,500)只创建一次,所有请求共享同一个实例
+	共享实例不允许添加header,需要header时请创建新的_HttpError
+	"""
+	def header(self,name,value):
+		raise TypeError('%s is shared and immutable, use _HttpError(%s) to add headers.' % (self.status,self.status[:3]))
+
+_BAD_REQUEST = _FrozenHttpError(400)
+_NOT_FOUND = _FrozenHttpError(404)
+_INTERNAL_ERROR = _FrozenHttpError(500)
+
 class _RedirectError(_HttpError):
 	"""
 	RedirectError that defines http redirect code
@@ -207,7 +235,7 @@ class _RedirectError(_HttpError):
 		Init an HttpError with response code.
 		"""
 		super(_RedirectError,self).__init__(code)
-		sef.location = location
+		self.location = location
 
 	def __str__(self):
 		return '%s %s' % (self.status,self.location)
@@ -223,7 +251,7 @@ class HttpError(object):
 		"""
 		send a bad request response
 		"""
-		return _HttpError(400)
+		return _BAD_REQUEST
 
 	@staticmethod
 	def unauthorized():
@@ -244,7 +272,7 @@ class HttpError(object):
 		"""
 		send an notfound response
 		"""
-		return _HttpError(404)
+		return _NOT_FOUND
 
 	@staticmethod
 	def conflict():
@@ -261,7 +289,7 @@ class HttpError(object):
 			...
 		_HttpError:500 Internal Server Error
 		"""
-		return _HttpError(500)
+		return _INTERNAL_ERROR
 
 	@staticmethod
 	def redirect(location):
@@ -289,31 +317,494 @@ class HttpError(object):
 
 _RESPONSE_HEADER_DICT = dict(zip(map(lambda x: x.upper(), _RESPONSE_HEADERS), _RESPONSE_HEADERS))
 
+# header名 ==> (大写的key, 规范写法),每种写法只计算一次
+_HEADER_NAMES = {}
+for _name in _RESPONSE_HEADERS:
+	_HEADER_NAMES[_name] = _HEADER_NAMES[_name.upper()] = (_name.upper(),_name)
+del _name
+
+def _header_name(name):
+	"""
+	>>> _header_name('content-type')
+	('CONTENT-TYPE', 'Content-Type')
+	>>> _header_name('X-Request-Id')
+	('X-REQUEST-ID', 'X-Request-Id')
+	"""
+	try:
+		return _HEADER_NAMES[name]
+	except KeyError:
+		key = name.upper()
+		r = (key,_RESPONSE_HEADER_DICT.get(key,name))
+		# 自定义header的写法不受控制,限制缓存的大小
+		if len(_HEADER_NAMES) < 1024:
+			_HEADER_NAMES[name] = r
+		return r
+
+_DEFAULT_RESPONSE_HEADERS = {'CONTENT-TYPE': ('Content-Type','text/html;charset=utf-8')}
+
+def get(path):
+	"""
+	@get('/blog/:id')装饰器,给处理函数标记GET路由
+	"""
+	def _decorator(func):
+		func.__web_route__ = path
+		func.__web_method__ = 'GET'
+		return func
+	return _decorator
+
+def post(path):
+	"""
+	@post('/signin')装饰器,给处理函数标记POST路由
+	"""
+	def _decorator(func):
+		func.__web_route__ = path
+		func.__web_method__ = 'POST'
+		return func
+	return _decorator
+
+class _Node(object):
+	"""
+	前缀树的节点,children是静态段 => 子节点,param是参数段的子节点,
+	handlers是到此为止的路径上注册的 方法 => 处理函数
+	"""
+	__slots__ = ('children','param','handlers')
+
+	def __init__(self):
+		self.children = {}
+		self.param = None
+		self.handlers = None
+
+class Router(object):
+	"""
+	url路由表
+	不带参数的路径以 路径 => {方法:处理函数} 存在字典里,匹配只需一次查找;
+	带:name参数的路径按'/'分段放进前缀树,匹配时逐段查找,静态段优先于参数段,
+	静态段走不通时退回参数段,代价只和路径的段数有关,和路由的数量无关
+	参数段必须是完整的一段,比如'/blog/:id',不支持'/blog/:id.json'
+	"""
+	def __init__(self):
+		self._static = {}
+		self._tree = _Node()
+
+	def add(self,method,path,func):
+		if not path.startswith('/'):
+			raise ValueError('Route must start with "/": %s' % path)
+		if ':' not in path:
+			handlers = self._static.setdefault(path,{})
+		else:
+			node = self._tree
+			for seg in path[1:].split('/'):
+				if seg.startswith(':'):
+					if not _RE_PARAM.match(seg):
+						raise ValueError('Invalid route segment "%s" in %s' % (seg,path))
+					if node.param is None:
+						node.param = _Node()
+					node = node.param
+				elif ':' in seg:
+					raise ValueError('Invalid route segment "%s" in %s' % (seg,path))
+				else:
+					node = node.children.setdefault(seg,_Node())
+			if node.handlers is None:
+				node.handlers = {}
+			handlers = node.handlers
+		if method in handlers:
+			logging.warning('Redefine route: %s %s' % (method,path))
+		handlers[method] = func
+
+	def match(self,method,path):
+		"""
+		返回(处理函数,参数列表),路径不存在时抛出404,路径存在但方法不对时抛出带Allow头的405
+		HEAD请求没有单独注册时使用GET的处理函数
+		"""
+		allowed = set()
+		handlers = self._static.get(path)
+		if handlers is not None:
+			func = _pick(handlers,method)
+			if func is not None:
+				return func,[]
+			allowed.update(handlers)
+		segs = path[1:].split('/')
+		# 先不回溯地走一遍,静态段优先,大多数路径在这里就能匹配
+		node = self._tree
+		args = []
+		for seg in segs:
+			child = node.children.get(seg)
+			if child is None:
+				child = node.param
+				if child is None or not seg:
+					break
+				args.append(seg)
+			node = child
+		else:
+			if node.handlers is not None:
+				func = _pick(node.handlers,method)
+				if func is not None:
+					return func,args
+		args = []
+		r = _search(self._tree,segs,0,method,args,allowed)
+		if r is not None:
+			return r,args
+		if allowed:
+			if 'GET' in allowed:
+				allowed.add('HEAD')
+			e = _HttpError(405)
+			e.header('Allow',', '.join(sorted(allowed)))
+			raise e
+		raise _NOT_FOUND
+
+_RE_PARAM = re.compile(r'^:[a-zA-Z_]\w*$')
+
+def _pick(handlers,method):
+	func = handlers.get(method)
+	if func is None and method == 'HEAD':
+		func = handlers.get('GET')
+	return func
+
+def _search(node,segs,i,method,args,allowed):
+	"""
+	深度优先匹配,找到时args中是按顺序的参数;只匹配路径而方法不对时把方法记入allowed
+	"""
+	if i == len(segs):
+		if node.handlers is None:
+			return None
+		func = _pick(node.handlers,method)
+		if func is None:
+			allowed.update(node.handlers)
+		return func
+	seg = segs[i]
+	child = node.children.get(seg)
+	if child is not None:
+		r = _search(child,segs,i + 1,method,args,allowed)
+		if r is not None:
+			return r
+	if node.param is not None and seg:
+		args.append(seg)
+		r = _search(node.param,segs,i + 1,method,args,allowed)
+		if r is not None:
+			return r
+		args.pop()
+	return None
+
+class MultipartFile(object):
+	"""
+	multipart表单中上传的文件
+		filename: 客户端给出的文件名(unicode)
+		file: 文件对象,已经定位到开头,不超过Request.spool_size时在内存中,否则在磁盘临时文件中
+		content_type: 该部分的Content-Type, size: 字节数
+	"""
+	def __init__(self,filename,file,content_type,size):
+		self.filename = filename
+		self.file = file
+		self.content_type = content_type
+		self.size = size
+
+
+class _BodyReader(object):
+	"""
+	按CONTENT_LENGTH读取wsgi.input,不会读到请求体之外,也就不会阻塞在还没有发来的数据上
+	服务端标记了wsgi.input_terminated时,没有CONTENT_LENGTH也可以读到结尾,
+	这时最多读max_size+1个字节,读满说明请求体超过了上限
+	长度超过max_size时抛出413
+	"""
+	def __init__(self,environ,max_size):
+		self.fp = environ['wsgi.input']
+		length = environ.get('CONTENT_LENGTH')
+		if length:
+			try:
+				self.remaining = int(length)
+			except ValueError:
+				raise _BAD_REQUEST
+			if self.remaining > max_size:
+				raise _HttpError(413)
+			self.unbounded = False
+		else:
+			self.unbounded = bool(environ.get('wsgi.input_terminated'))
+			self.remaining = max_size + 1 if self.unbounded else 0
+
+	def read(self,size=65536):
+		if self.remaining <= 0:
+			return ''
+		data = self.fp.read(min(size,self.remaining))
+		if not data:
+			self.remaining = 0
+			return ''
+		self.remaining -= len(data)
+		if self.unbounded and self.remaining == 0:
+			raise _HttpError(413)
+		return data
+
+	def read_all(self):
+		L = []
+		while True:
+			data = self.read()
+			if not data:
+				break
+			L.append(data)
+		return ''.join(L)
+
+
+class _StreamBuffer(object):
+	"""
+	multipart解析用的缓冲区,只保留还没有处理的数据
+	"""
+	def __init__(self,reader):
+		self.reader = reader
+		self.buf = ''
+
+	def _fill(self):
+		data = self.reader.read()
+		if not data:
+			return False
+		self.buf += data
+		return True
+
+	def read_until(self,sep,limit):
+		"""
+		返回sep之前的数据并跳过sep,超过limit字节还没有找到sep或数据提前结束时抛出400
+		"""
+		while True:
+			i = self.buf.find(sep)
+			if i >= 0:
+				r = self.buf[:i]
+				self.buf = self.buf[i + len(sep):]
+				return r
+			if len(self.buf) > limit or not self._fill():
+				raise _BAD_REQUEST
+
+	def read_exact(self,n):
+		while len(self.buf) < n:
+			if not self._fill():
+				raise _BAD_REQUEST
+		r = self.buf[:n]
+		self.buf = self.buf[n:]
+		return r
+
+	def copy_until(self,sep,sink,limit):
+		"""
+		把sep之前的数据边读边写入sink并跳过sep,返回写入的字节数,超过limit时抛出413
+		缓冲区中只留下可能是sep开头的最后len(sep)-1个字节
+		"""
+		size = 0
+		keep = len(sep) - 1
+		while True:
+			i = self.buf.find(sep)
+			if i >= 0:
+				data = self.buf[:i]
+				self.buf = self.buf[i + len(sep):]
+			elif len(self.buf) > keep:
+				data = self.buf[:-keep]
+				self.buf = self.buf[-keep:]
+			else:
+				data = ''
+			if data:
+				size += len(data)
+				if size > limit:
+					raise _HttpError(413)
+				sink.write(data)
+			if i >= 0:
+				return size
+			if not self._fill():
+				raise _BAD_REQUEST
+
+
+def _add_input(inputs,key,value):
+	"""
+	同名的多个值保存为列表,单个值直接保存
+	"""
+	old = inputs.get(key)
+	if old is None:
+		inputs[key] = value
+	elif isinstance(old,list):
+		old.append(value)
+	else:
+		inputs[key] = [old,value]
+
+def _parse_qs(inputs,qs):
+	for k,v in urlparse.parse_qsl(qs,keep_blank_values=True):
+		_add_input(inputs,utils.to_unicode(k),utils.to_unicode(v))
+
+def _parse_multipart(inputs,reader,boundary,max_part_size,spool_size):
+	buf = _StreamBuffer(reader)
+	delim = '--' + boundary
+	buf.read_until(delim,65536)
+	while True:
+		tail = buf.read_exact(2)
+		if tail == '--':
+			break
+		if tail != '\r\n':
+			raise _BAD_REQUEST
+		name = filename = None
+		content_type = 'text/plain'
+		for line in buf.read_until('\r\n\r\n',16384).split('\r\n'):
+			k,_,v = line.partition(':')
+			k = k.strip().lower()
+			if k == 'content-disposition':
+				params = cgi.parse_header(v)[1]
+				name = params.get('name')
+				filename = params.get('filename')
+			elif k == 'content-type':
+				content_type = v.strip()
+		if name is None:
+			raise _BAD_REQUEST
+		if filename is None:
+			sink = StringIO()
+			buf.copy_until('\r\n' + delim,sink,max_part_size)
+			_add_input(inputs,utils.to_unicode(name),utils.to_unicode(sink.getvalue()))
+		else:
+			sink = tempfile.SpooledTemporaryFile(max_size=spool_size)
+			size = buf.copy_until('\r\n' + delim,sink,max_part_size)
+			sink.seek(0)
+			_add_input(inputs,utils.to_unicode(name),MultipartFile(utils.to_unicode(filename),sink,content_type,size))
+	# 读完结尾,保持连接可以继续使用
+	while reader.read():
+		pass
+
+
+class _lazy_property(object):
+	"""
+	只计算一次的属性,结果保存在实例的__dict__中,之后的读取不再经过描述符
+	"""
+	def __init__(self,func):
+		self.func = func
+		self.__name__ = func.__name__
+		self.__doc__ = func.__doc__
+
+	def __get__(self,obj,cls):
+		if obj is None:
+			return self
+		value = obj.__dict__[self.__name__] = self.func(obj)
+		return value
+
+
+# 请求头名 => environ中的键,比如'Content-Type' => 'CONTENT_TYPE','User-Agent' => 'HTTP_USER_AGENT'
+_ENVIRON_KEYS = {}
+
+def _environ_key(name):
+	key = _ENVIRON_KEYS.get(name)
+	if key is None:
+		key = name.upper().replace('-','_')
+		if key not in ('CONTENT_TYPE','CONTENT_LENGTH'):
+			key = 'HTTP_' + key
+		if len(_ENVIRON_KEYS) < 1024:
+			_ENVIRON_KEYS[name] = key
+	return key
+
+
+class _EnvironHeaders(object):
+	"""
+	直接基于environ的只读请求头视图,名字不区分大小写
+	读取时才把名字转换成environ中的键,值解码成unicode后按键缓存,
+	遍历时的名字是大写加'-'的形式,比如'USER-AGENT'
+	"""
+	__slots__ = ('_environ','_cache')
+
+	def __init__(self,environ):
+		self._environ = environ
+		self._cache = {}
+
+	def get(self,name,default=None):
+		key = _environ_key(name)
+		value = self._cache.get(key)
+		if value is None:
+			raw = self._environ.get(key)
+			if raw is None:
+				return default
+			value = self._cache[key] = raw.decode('utf-8','replace')
+		return value
+
+	def __getitem__(self,name):
+		value = self.get(name)
+		if value is None:
+			raise KeyError(name)
+		return value
+
+	def __contains__(self,name):
+		return _environ_key(name) in self._environ
+
+	def iterkeys(self):
+		for k in self._environ:
+			if k.startswith('HTTP_'):
+				yield k[5:].replace('_','-')
+			elif k in ('CONTENT_TYPE','CONTENT_LENGTH'):
+				yield k.replace('_','-')
+
+	__iter__ = iterkeys
+
+	def keys(self):
+		return list(self.iterkeys())
+
+	def iteritems(self):
+		for k in self.iterkeys():
+			yield k,self[k]
+
+	def items(self):
+		return list(self.iteritems())
+
+	def __len__(self):
+		return len(self.keys())
+
+	def __repr__(self):
+		return '<headers %r>' % dict(self.iteritems())
+
+
+class _ReadOnlyDict(dict):
+	"""
+	解析后的cookie,多个中间件共享同一个结果,不允许修改
+	"""
+	def _readonly(self,*args,**kw):
+		raise TypeError('%s is read-only.' % self.__class__.__name__)
+
+	__setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+
+
 class Request(object):
+	"""
+	请求体在第一次通过request[...]/get/gets/input取参数,或调用get_body/json时才读取,
+	不关心请求体的处理函数不会读取wsgi.input
+	max_body_size: 请求体的最大字节数, max_part_size: multipart中每一部分的最大字节数,超过时返回413
+	spool_size: 上传的文件超过该字节数时写入磁盘临时文件
+	"""
+	max_body_size = 16 * 1024 * 1024
+	max_part_size = 16 * 1024 * 1024
+	spool_size = 512 * 1024
+
 	def __init__(self,environ):
 		self._environ = environ
 
 	def _parse_input(self):
 		"""
-		将通过wsgi传入的参数解析成字典对象返回
+		将查询字符串和请求体中的参数解析成字典对象返回,同名的多个值保存为列表
 		比如：request({'REQUEST_METHOD':'POST','wsgi.input':StringIO('a=1&b=Mjkjkjkjk')})
 			这里解析的就是wsgi.input对象里面的字节流
+		请求体支持application/x-www-form-urlencoded,multipart/form-data和application/json,
+		json请求体是对象时,其中的每个键作为一个参数
+		GET/HEAD请求只解析查询字符串
 		"""
-			def _convert(item):
-				if isinstance(item,list):
-					return [utils.to_unicode(i,value) for i in item]
-				if item.filename:
-					return MultipartFile(item)
-				return utils.to_unicode(item.value)
-			fs = cgi.FieldStorage(fp=self._environ['wsgi.input'],environ=self._environ,keep_blank_values=True)
-			inputs = dict()
-			for key in fs:
-				inputs[key] = _convert(fs[key])
-			return inputs
+		inputs = dict()
+		if self._environ['REQUEST_METHOD'] not in ('GET','HEAD'):
+			content_type,params = cgi.parse_header(self._environ.get('CONTENT_TYPE',''))
+			if content_type == 'multipart/form-data':
+				boundary = params.get('boundary')
+				if not boundary:
+					raise _BAD_REQUEST
+				self._body_consumed = True
+				_parse_multipart(inputs,_BodyReader(self._environ,self.max_body_size),boundary,self.max_part_size,self.spool_size)
+			elif content_type == 'application/x-www-form-urlencoded':
+				_parse_qs(inputs,self.get_body())
+			elif content_type == 'application/json':
+				data = self.json
+				if isinstance(data,dict):
+					for k,v in data.iteritems():
+						# 列表值整个作为一个参数,不当作多个同名参数
+						inputs[k] = [v] if isinstance(v,list) else v
+		qs = self._environ.get('QUERY_STRING')
+		if qs:
+			_parse_qs(inputs,qs)
+		return inputs
 
 	def _get_raw_input(self):
 		if not hasattr(self,'_raw_input'):
-			sefl._raw_input = self._parse_input()
+			self._raw_input = self._parse_input()
 		return self._raw_input
 
 	def __getitem__(self,key):
@@ -341,15 +832,31 @@ class Request(object):
 		copy = Dict(**kw)
 		raw = self._get_raw_input()
 		for k,v in raw.iteritems():
-			cpoy[k] = v[0] if isinstance(v,list) else v
+			copy[k] = v[0] if isinstance(v,list) else v
 		return copy
 
 	def get_body(self):
 		"""
 		从http post请求中取得body里面的数据，返回一个str对象
+		最多读取max_body_size字节,读取的结果会被缓存;multipart请求体解析时是流式读取的,之后不能再取得
+		"""
+		if not hasattr(self,'_body'):
+			if getattr(self,'_body_consumed',False):
+				raise ValueError('Request body has been consumed by multipart parsing.')
+			self._body = _BodyReader(self._environ,self.max_body_size).read_all()
+		return self._body
+
+	@property
+	def json(self):
+		"""
+		解析成json的请求体,请求体不是合法的json时抛出400
 		"""
-		fp = self._environ['wsgi.input']
-		return fp.read()
+		if not hasattr(self,'_json'):
+			try:
+				self._json = json.loads(self.get_body())
+			except ValueError:
+				raise _BAD_REQUEST
+		return self._json
 
 	@property
 	def remote_addr(self):
@@ -371,7 +878,7 @@ class Request(object):
 	def request_method(self):
 		return self._environ['REQUEST_METHOD']
 
-	@property
+	@_lazy_property
 	def path_info(self):
 		return urllib.unquote(self._environ.get('PATH_INFO',''))
 
@@ -379,70 +886,87 @@ class Request(object):
 	def host(self):
 		return self._environ.get('HTTP_HOST','')
 
-	def _get_headers(self):
-		if not hasattr(self,'_headers'):
-			hdrs = {}
-			for k,v in self._environ.iteritems():
-				if k.startswith('HTTP_'):
-					hdrs[k[5:].replace('_','-').upper()] = v.decode('uft-8')
-			self._headers = hdrs
-		return self._headers
-
-	@property
+	@_lazy_property
 	def headers(self):
-		return dict(**self._get_headers())
+		"""
+		只读的请求头视图,request.headers['User-Agent']和request.headers['USER-AGENT']等价
+		"""
+		return _EnvironHeaders(self._environ)
 
 	def header(self,header,defalut=None):
-		return self._get_headers().get(header.upper(),defalut)
-
-	def _get_cookies(self):
-		if not hasattr(self,'_cookies'):
-			cookies = {}
-			cookie_str = self._environ.get('HTTP_COOKIE')
-			if cookie_str:
-				for c in cookie_str.split(';'):
-					pos = c.find('=')
-					if pos > 0:
-						cookies[c[:pos].strip()] = utils.unquote(c[pos+1:])
-			self._cookies = cookies
-		return self._cookies
+		return self.headers.get(header,defalut)
 
-	@property
+	@_lazy_property
 	def cookies(self):
-		return self._get_cookies().get(name,defalut)
+		"""
+		解析全部cookie,返回只读的字典,同名cookie取第一个
+		"""
+		cookies = _ReadOnlyDict()
+		cookie_str = self._environ.get('HTTP_COOKIE')
+		if cookie_str:
+			for c in cookie_str.split(';'):
+				pos = c.find('=')
+				if pos > 0:
+					name = c[:pos].strip()
+					if name not in cookies:
+						dict.__setitem__(cookies,name,utils.unquote(c[pos+1:]))
+		return cookies
+
+	def cookie(self,name,defalut=None):
+		"""
+		取得一个cookie,没有解析过全部cookie时只解码这一个
+		"""
+		cookies = self.__dict__.get('cookies')
+		if cookies is not None:
+			return cookies.get(name,defalut)
+		cookie_str = self._environ.get('HTTP_COOKIE')
+		if cookie_str:
+			for c in cookie_str.split(';'):
+				pos = c.find('=')
+				if pos > 0 and c[:pos].strip() == name:
+					return utils.unquote(c[pos+1:])
+		return defalut
 
 class Response(object):
-
+	"""
+	_headers保存 大写的key ==> (规范写法,值),值本身就是WSGI需要的header元组
+	headers属性生成的列表会被缓存,修改header或cookie时作废
+	"""
 	def __init__(self):
-		self._status = '200ok'
-		self._headers = {'CONTENT-TYPE':'text/html;charset=utf-8'}
+		self._status = '200 OK'
+		self._headers = _DEFAULT_RESPONSE_HEADERS.copy()
+		self._cookies = None
+		self._header_list = None
 
 	def unset_header(self,name):
-		key = name.upper()
-		if key not in _RESPONSE_HEADER_DICT:
-			key = name
+		key = _header_name(name)[0]
 		if key in self._headers:
 			del self._headers[key]
+			self._header_list = None
 
 	def set_header(self,name,value):
-		key = name.upper()
-		if key not in _RESPONSE_HEADER_DICT:
-			key = name
-		self._headers[key] = utils.to_str(value)
+		key,name = _header_name(name)
+		self._headers[key] = (name,utils.to_str(value))
+		self._header_list = None
 
 	def header(self,name):
-		key = name.upper()
-		if key not in _RESPONSE_HEADER_DICT:
-			key = name
-		return self._headers.get(key)
+		h = self._headers.get(_header_name(name)[0])
+		if h is not None:
+			return h[1]
 
 	@property
 	def headers(self):
-		L = [(_RESPONSE_HEADER_DICT.get(k,v)),v for k,v in self._headers.iteritems()]
-		if hasattr(self,'_cookies'):
-			for v in self._cookies.itervalues():
-				L.append(('Set-Cookie',v))
-		L.append(_HEADER_X_POWERED_BY)
+		"""
+		返回WSGI格式的header列表,同一个Response多次读取返回同一个列表,不要修改它
+		"""
+		L = self._header_list
+		if L is None:
+			L = self._headers.values()
+			if self._cookies:
+				for v in self._cookies.itervalues():
+					L.append(('Set-Cookie',v))
+			L.append(_HEADER_X_POWERED_BY)
+			self._header_list = L
 		return L
 
 	@property
@@ -467,16 +991,298 @@ class Response(object):
 	def delete_cookie(self,name):
 		self.set_cookie(name,'__delete__',expires=0)
 
-	def set_cookie(self,name,value,max_age,expires=None,path='/',domain)	
-	
-	
+	def set_cookie(self,name,value,max_age=None,expires=None,path='/',domain=None,secure=False,http_only=True):
+		"""
+		设置cookie,expires是时间戳,给出expires时忽略max_age
+		"""
+		if self._cookies is None:
+			self._cookies = {}
+		L = ['%s=%s' % (utils.quote(name),utils.quote(value))]
+		if expires is not None:
+			L.append('Expires=%s' % time.strftime('%a, %d-%b-%Y %H:%M:%S GMT',time.gmtime(expires)))
+		elif max_age is not None:
+			L.append('Max-Age=%d' % max_age)
+		if path:
+			L.append('Path=%s' % path)
+		if domain:
+			L.append('Domain=%s' % domain)
+		if secure:
+			L.append('Secure')
+		if http_only:
+			L.append('HttpOnly')
+		self._cookies[name] = '; '.join(L)
+		self._header_list = None
+
+	def unset_cookie(self,name):
+		if self._cookies and name in self._cookies:
+			del self._cookies[name]
+			self._header_list = None
+
+	@property
+	def status_code(self):
+		return int(self._status[:3])
 
-	
-	
-	
-	
-	
-	
-	
+	@property
+	def status(self):
+		return self._status
 
-		
+	@status.setter
+	def status(self,value):
+		"""
+		可以是数字200,也可以是'200 OK'这样的字符串
+		"""
+		if isinstance(value,(int,long)):
+			line = _STATUS_LINES.get(value)
+			if line is None:
+				raise ValueError('Bad response code: %d' % value)
+			self._status = line
+		elif isinstance(value,basestring):
+			value = utils.to_str(value)
+			if value not in _STATUS_LINE_SET and not _RE_RESPONSE_STATUS.match(value):
+				raise ValueError('Bad response code: %s' % value)
+			self._status = value
+		else:
+			raise TypeError('Bad type of response code.')
+
+
+_RE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def _parse_range(value,size):
+	"""
+	解析只有一段的Range头,返回(start,end),end包含在内
+	格式不对或有多段时返回None,按完整文件响应;范围不可满足时返回(size,size)
+	>>> _parse_range('bytes=0-99',1000), _parse_range('bytes=900-',1000), _parse_range('bytes=-100',1000)
+	((0, 99), (900, 999), (900, 999))
+	>>> _parse_range('bytes=0-99,200-299',1000), _parse_range('bytes=1000-',1000)
+	(None, (1000, 1000))
+	"""
+	m = _RE_RANGE.match(value.replace(' ',''))
+	if m is None:
+		return None
+	first,last = m.groups()
+	if first:
+		start = int(first)
+		end = int(last) if last else size - 1
+		if last and end < start:
+			return None
+		if start >= size:
+			return size,size
+		return start,min(end,size - 1)
+	if not last:
+		return None
+	length = int(last)
+	if length == 0 or size == 0:
+		return size,size
+	return max(size - length,0),size - 1
+
+class _FileIter(object):
+	"""
+	从当前位置起按块读出length个字节,服务器调用close()时关闭文件
+	"""
+	def __init__(self,f,length,chunk_size):
+		self._f = f
+		self._remaining = length
+		self._chunk_size = chunk_size
+
+	def __iter__(self):
+		read = self._f.read
+		chunk_size = self._chunk_size
+		while self._remaining > 0:
+			data = read(min(chunk_size,self._remaining))
+			if not data:
+				break
+			self._remaining -= len(data)
+			yield data
+
+	def close(self):
+		self._f.close()
+
+class StaticFiles(object):
+	"""
+	静态文件的wsgi处理函数,PATH_INFO映射到root下的文件
+	含有'..'的路径一律返回404,不会访问root之外的文件
+	ETag和Last-Modified按(路径,mtime,size)缓存,文件修改后自动重新计算
+	"""
+	chunk_size = 64 * 1024
+	max_cached = 4096
+
+	def __init__(self,root,max_age=None):
+		self.root = os.path.abspath(root)
+		self.max_age = max_age
+		# 路径 ==> (mtime,size,etag,last_modified,content_type)
+		self._meta = {}
+
+	def _file_path(self,path):
+		parts = []
+		for p in path.split('/'):
+			if not p or p == '.':
+				continue
+			if p == '..' or '\0' in p or '\\' in p or (os.altsep and os.altsep in p):
+				return None
+			parts.append(p)
+		if not parts:
+			return None
+		return os.path.join(self.root,*parts)
+
+	def _stat(self,fpath):
+		try:
+			st = os.stat(fpath)
+		except (OSError,ValueError):
+			return None
+		if not stat.S_ISREG(st.st_mode):
+			return None
+		meta = self._meta.get(fpath)
+		if meta is None or meta[0] != st.st_mtime or meta[1] != st.st_size:
+			meta = (st.st_mtime,st.st_size,'"%x-%x"' % (int(st.st_mtime * 1000),st.st_size),
+				formatdate(st.st_mtime,usegmt=True),
+				mimetypes.guess_type(fpath)[0] or 'application/octet-stream')
+			if len(self._meta) >= self.max_cached:
+				self._meta.clear()
+			self._meta[fpath] = meta
+		return meta
+
+	def _not_modified(self,environ,etag,mtime):
+		inm = environ.get('HTTP_IF_NONE_MATCH')
+		if inm is not None:
+			for tag in inm.split(','):
+				tag = tag.strip()
+				if tag == '*' or tag == etag or tag == 'W/' + etag:
+					return True
+			return False
+		ims = environ.get('HTTP_IF_MODIFIED_SINCE')
+		if ims:
+			t = parsedate(ims.split(';')[0])
+			if t is not None and int(mtime) <= calendar.timegm(t):
+				return True
+		return False
+
+	def _range(self,environ,size,etag,last_modified):
+		value = environ.get('HTTP_RANGE')
+		if not value:
+			return None
+		if_range = environ.get('HTTP_IF_RANGE')
+		if if_range and if_range != etag and if_range != last_modified:
+			return None
+		return _parse_range(value,size)
+
+	def __call__(self,environ,start_response):
+		method = environ.get('REQUEST_METHOD','GET')
+		if method != 'GET' and method != 'HEAD':
+			start_response(_STATUS_LINES[405],[('Allow','GET, HEAD'),_HEADER_X_POWERED_BY])
+			return []
+		fpath = self._file_path(environ.get('PATH_INFO',''))
+		meta = self._stat(fpath) if fpath else None
+		if meta is None:
+			start_response(_NOT_FOUND.status,[('Content-Type','text/html;charset=utf-8'),_HEADER_X_POWERED_BY])
+			return ['<html><body><h1>',_NOT_FOUND.status,'</h1></body></html>']
+		mtime,size,etag,last_modified,content_type = meta
+		headers = [('ETag',etag),('Last-Modified',last_modified),('Accept-Ranges','bytes'),_HEADER_X_POWERED_BY]
+		if self.max_age is not None:
+			headers.append(('Cache-Control','max-age=%d' % self.max_age))
+		if self._not_modified(environ,etag,mtime):
+			start_response(_STATUS_LINES[304],headers)
+			return []
+		r = self._range(environ,size,etag,last_modified)
+		if r is None:
+			status,start,length = _STATUS_LINES[200],0,size
+		elif r[0] >= size:
+			headers.append(('Content-Range','bytes */%d' % size))
+			start_response(_STATUS_LINES[416],headers)
+			return []
+		else:
+			start,end = r
+			status,length = _STATUS_LINES[206],end - start + 1
+			headers.append(('Content-Range','bytes %d-%d/%d' % (start,end,size)))
+		headers.append(('Content-Type',content_type))
+		headers.append(('Content-Length',str(length)))
+		if method == 'HEAD':
+			start_response(status,headers)
+			return []
+		try:
+			f = open(fpath,'rb')
+		except IOError:
+			start_response(_NOT_FOUND.status,[_HEADER_X_POWERED_BY])
+			return []
+		start_response(status,headers)
+		# file_wrapper会一直发送到文件末尾,只用于完整文件
+		if length == size and 'wsgi.file_wrapper' in environ:
+			return environ['wsgi.file_wrapper'](f,self.chunk_size)
+		if start:
+			f.seek(start)
+		return _FileIter(f,length,self.chunk_size)
+
+
+class WSGIApplication(object):
+	"""
+	wsgi处理函数的封装,持有路由表
+	处理请求时把Request和Response放到ctx中,按路由调用处理函数,
+	处理函数返回str/unicode或可迭代的str作为响应内容,抛出_HttpError时返回对应的错误页
+	给出document_root时,/static/下的路径和/favicon.ico不经过路由,直接由StaticFiles返回文件
+	"""
+	def __init__(self,document_root=None):
+		self._document_root = document_root
+		self._router = Router()
+		self._static = StaticFiles(document_root) if document_root else None
+
+	def add_url(self,func):
+		route = getattr(func,'__web_route__',None)
+		if route is None:
+			raise ValueError('No route defined for %s, use @get or @post.' % func.__name__)
+		self._router.add(func.__web_method__,route,func)
+		logging.info('Add route: %s %s' % (func.__web_method__,route))
+
+	def add_module(self,mod):
+		"""
+		注册模块中所有用@get/@post装饰过的函数
+		"""
+		if isinstance(mod,basestring):
+			mod = __import__(mod,globals(),locals())
+		for name in dir(mod):
+			func = getattr(mod,name)
+			if callable(func) and hasattr(func,'__web_route__'):
+				self.add_url(func)
+
+	def get_wsgi_application(self):
+		router = self._router
+		static = self._static
+
+		def wsgi(env,start_response):
+			if static is not None:
+				path = env.get('PATH_INFO','')
+				if path.startswith('/static/') or path == '/favicon.ico':
+					return static(env,start_response)
+			ctx.request = request = Request(env)
+			ctx.response = response = Response()
+			try:
+				func,args = router.match(request.request_method,request.path_info)
+				r = func(*args)
+				if isinstance(r,unicode):
+					r = r.encode('utf-8')
+				if isinstance(r,str):
+					r = [r]
+				elif r is None:
+					r = []
+				start_response(response.status,response.headers)
+				return r
+			except _RedirectError,e:
+				response.set_header('Location',e.location)
+				start_response(e.status,response.headers)
+				return []
+			except _HttpError,e:
+				start_response(e.status,response.headers + e.headers)
+				return ['<html><body><h1>',e.status,'</h1></body></html>']
+			except Exception,e:
+				logging.exception(e)
+				start_response(_INTERNAL_ERROR.status,[])
+				return ['<html><body><h1>500 Internal Server Error</h1></body></html>']
+			finally:
+				del ctx.request
+				del ctx.response
+
+		return wsgi
+
+	def run(self,port=9000,host='127.0.0.1'):
+		from wsgiref.simple_server import make_server
+		logging.info('application (%s) will start at %s:%s...' % (self._document_root,host,port))
+		server = make_server(host,port,self.get_wsgi_application())
+		server.serve_forever()